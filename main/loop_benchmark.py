@@ -0,0 +1,311 @@
+"""End-to-end benchmark of the speaker -> agent -> kit loop.
+
+Replays synthetic or recorded speech into the streaming classifier, at real-time
+pace or faster. The classifier's pleasure goes over loopback OSC to an Agent
+with a stand-in kit, and /action-values are captured on the agent's send port.
+Latencies are measured per chunk:
+
+  classification  chunk captured -> pleasure published
+  osc             pleasure published -> received by the agent
+  agent-wait      received by the agent -> agent tick using it
+  tick            agent tick -> /action-values received
+  end-to-end      chunk captured -> /action-values received
+
+and throughput (chunks and agent ticks per second while audio is fed). Each
+/pleasure carries the sequence number of its chunk and each /action-values the
+number of its tick, so stages are matched by number, not by arrival order.
+Results are compared to a baseline file and the script exits with status 1 on
+a regression:
+
+    python loop_benchmark.py --model ../pyannote/trustnet.pt --save-baseline   # record the baseline
+    python loop_benchmark.py --model ../pyannote/trustnet.pt                   # compare against it
+
+The agent does not send motor commands yet: the stand-in kit counts the commands
+it receives, so motor latency will be covered once the agent acts.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+from pythonosc import dispatcher, osc_server
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pyannote'))
+from latency import PipelineMonitor
+from speaker_stream import SpeakerStream
+
+from teleo import Agent
+
+STAGES = ['classification', 'osc', 'agent-wait', 'tick', 'end-to-end']
+DEFAULT_BASELINE = "loop_benchmark_baseline.json"
+
+
+def synthetic_speech(duration, sample_rate=16000, seed=0):
+    """Deterministic speech-like signal: harmonics of a wandering pitch, in syllable-rate bursts, plus noise."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    pitch = 140 + 40 * np.sin(2 * np.pi * 0.5 * t) + 10 * rng.standard_normal(1)
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+    voice = sum(np.sin(k * phase) / k for k in range(1, 20))
+    envelope = 0.5 * (1 + np.sin(2 * np.pi * 4 * t)) ** 2
+    audio = 0.2 * envelope * voice + 0.005 * rng.standard_normal(len(t))
+    return (audio / max(np.abs(audio).max(), 1e-6) * 0.8).astype(np.float32)
+
+
+class AlwaysVoiced:
+    """VAD stand-in: treats every frame as speech (synthetic audio is not speech to webrtcvad)."""
+    def is_speech(self, frame, sample_rate):
+        return True
+
+
+class StandInKit:
+    """Stand-in for MisBKit: already paired, records the commands sent to it."""
+    def __init__(self, id=0, motor_ids=(1, 2)):
+        self.id = id
+        self.is_paired = True
+        self.motor_ids = list(motor_ids)
+        self.commands = []
+
+    def send(self, address, *args):
+        self.commands.append((time.perf_counter(), address, args))
+
+    def send_bundle(self, messages):
+        for address, args in messages.items():
+            self.send(address, args)
+
+    def loop(self):
+        pass
+
+    def begin(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def wheel(self, motor_id, speed):
+        self.send("/set/motor/wheel", motor_id, speed)
+
+    def joint(self, motor_id, speed):
+        self.send("/set/motor/joint", motor_id, speed)
+
+    def speed(self, motor_id, speed):
+        self.send("/set/motor/speed", motor_id, speed)
+
+    def stop(self, motor_id):
+        self.send("/set/motor/stop", motor_id)
+
+    def stop_all(self):
+        self.send("/stop-all")
+
+
+class BenchmarkStream(SpeakerStream):
+    """SpeakerStream that numbers its /pleasure messages and remembers when each chunk was captured and published."""
+    def __init__(self, *args, **kwargs):
+        super(BenchmarkStream, self).__init__(*args, **kwargs)
+        self.published = []  # (capture time, publish time), indexed by sequence number
+
+    def publish(self, pleasure, capture_time):
+        self.published.append((capture_time, time.perf_counter()))
+        # The agent only reads the first argument: the sequence number rides along.
+        self.client.send_message("/pleasure", [pleasure, len(self.published) - 1])
+
+
+class LoopBenchmark:
+    def __init__(self, agent, stream, kit, listen_port=8000):
+        self.agent = agent
+        self.stream = stream
+        self.kit = kit
+        self.monitor = PipelineMonitor(STAGES)
+        self.received = {}  # sequence number -> receive time
+        self.last_received = None
+        self.ticks = []  # sequence number of the pleasure used by each tick (or None), and tick time
+        self.action_times = {}  # tick number -> receive time of its /action-values
+        self.done = threading.Event()
+
+        # Agent hooks: note when each pleasure arrives and which one each tick consumes.
+        receive_pleasure = agent.receivePleasure
+        def receivePleasure(data):
+            if len(data) > 1:
+                self.received[int(data[1])] = time.perf_counter()
+                self.last_received = int(data[1])
+            receive_pleasure(data)
+        agent.oscHelper.map("/pleasure", receivePleasure)
+        update = agent.update
+        def tick():
+            consumed = self.last_received if agent.currentPleasure is not None else None
+            self.last_received = None
+            self.ticks.append((consumed, time.perf_counter()))
+            update()
+        agent.update = tick
+        # The tick number rides along with /action-values (the agent sends it from update()).
+        send_message = agent.oscHelper.send_message
+        def stamped(path, args):
+            if path == "/action-values":
+                args = list(args) + [len(self.ticks) - 1]
+            send_message(path, args)
+        agent.oscHelper.send_message = stamped
+
+        # Loopback listener on the agent's send port (which also receives state and /load/* messages).
+        osc_dispatcher = dispatcher.Dispatcher()
+        osc_dispatcher.map("/action-values", self.receive_action_values)
+        self.server = osc_server.ThreadingOSCUDPServer(("127.0.0.1", listen_port), osc_dispatcher)
+
+    def receive_action_values(self, address, *args):
+        # First copy only, in case of duplicates.
+        self.action_times.setdefault(int(args[-1]), time.perf_counter())
+
+    def feed(self, audio, speed):
+        """Feeds audio frame by frame, at speed times real time."""
+        frame_samples = self.stream.frame_samples
+        frame_period = frame_samples / self.stream.sample_rate / speed
+        start_time = time.perf_counter()
+        for i in range(len(audio) // frame_samples):
+            # Frames are "captured" on schedule, whenever the feeder wakes up.
+            capture_time = start_time + (i + 1) * frame_period
+            delay = capture_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.stream.feed(audio[i * frame_samples:(i + 1) * frame_samples], capture_time)
+
+    def infer(self):
+        while not self.done.is_set():
+            self.stream.step(timeout=0.05)
+
+    def run(self, audio, speed=1.0, drain=1.0):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        inference = threading.Thread(target=self.infer, daemon=True)
+        inference.start()
+        feeder = threading.Thread(target=self.feed, args=(audio, speed), daemon=True)
+        start_time = feed_end = time.perf_counter()
+        feeder.start()
+        self.agent.start()
+        while feeder.is_alive() or time.perf_counter() - feed_end < drain:
+            if feeder.is_alive():
+                feed_end = time.perf_counter()
+            self.agent.step()
+            self.agent.sendState()
+        self.done.set()
+        inference.join()
+        self.server.shutdown()
+        self.start_time = start_time
+        self.feed_end = feed_end
+        return self.results(len(audio) / self.stream.sample_rate)
+
+    def results(self, audio_duration):
+        for tick_index, (consumed, tick_time) in enumerate(self.ticks):
+            if consumed is None or consumed not in self.received or tick_index not in self.action_times:
+                continue
+            capture_time, publish_time = self.stream.published[consumed]
+            action_time = self.action_times[tick_index]
+            self.monitor.record('classification', capture_time, publish_time)
+            self.monitor.record('osc', publish_time, self.received[consumed])
+            self.monitor.record('agent-wait', self.received[consumed], tick_time)
+            self.monitor.record('tick', tick_time, action_time)
+            self.monitor.record('end-to-end', capture_time, action_time)
+        # Throughput while audio is fed: chunks published and ticks run during the drain are not counted.
+        elapsed = self.feed_end - self.start_time
+        n_chunks = sum(1 for capture_time, publish_time in self.stream.published if publish_time <= self.feed_end)
+        n_ticks = sum(1 for consumed, tick_time in self.ticks if tick_time <= self.feed_end)
+        results = { 'latency_ms': {}, 'audio_seconds': audio_duration, 'elapsed_seconds': elapsed,
+                    'chunks_per_second': n_chunks / elapsed,
+                    'ticks_per_second': n_ticks / elapsed,
+                    'published': len(self.stream.published), 'dropped': self.stream.monitor.dropped,
+                    'lost_osc': len(self.stream.published) - len(self.received),
+                    'lost_action_values': len(self.ticks) - len(self.action_times),
+                    'kit_commands': len(self.kit.commands) }
+        for stage, histogram in self.monitor.histograms.items():
+            if histogram.n > 0:
+                results['latency_ms'][stage] = { 'n': histogram.n,
+                    'p50': 1000 * histogram.percentile(50), 'p95': 1000 * histogram.percentile(95),
+                    'p99': 1000 * histogram.percentile(99), 'max': 1000 * histogram.max }
+        return results
+
+
+def regressions(results, baseline, tolerance):
+    """Metrics worse than the baseline by more than tolerance (a fraction), or measured in the baseline but not now."""
+    found = []
+    for stage, percentiles in baseline['latency_ms'].items():
+        for p in ('p50', 'p95'):
+            value = results['latency_ms'].get(stage, {}).get(p)
+            if value is None:
+                found.append("{} {}: not measured (baseline {:.1f} ms)".format(stage, p, percentiles[p]))
+            elif value > percentiles[p] * (1 + tolerance):
+                found.append("{} {}: {:.1f} ms (baseline {:.1f} ms)".format(stage, p, value, percentiles[p]))
+    for metric in ('chunks_per_second', 'ticks_per_second'):
+        if metric not in baseline:
+            continue
+        if results[metric] < baseline[metric] * (1 - tolerance):
+            found.append("{}: {:.2f} (baseline {:.2f})".format(metric, results[metric], baseline[metric]))
+    return found
+
+
+def unchecked(results, baseline):
+    """Metrics measured now that the baseline does not have, so they could not be compared."""
+    missing = [stage for stage in results['latency_ms'] if stage not in baseline['latency_ms']]
+    return missing + [metric for metric in ('chunks_per_second', 'ticks_per_second') if metric not in baseline]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model", type=str, help="Trustnet model filename", default="trustnet.pt")
+    parser.add_argument("--audio", type=str, help="Recorded speech to replay (default: synthetic speech)", default=None)
+    parser.add_argument("--duration", type=float, help="Duration of the synthetic speech in seconds", default=30.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--speed", type=float, help="Replay speed (1 = real time)", default=1.0)
+    parser.add_argument("--vad", help="Run the VAD (default: only on recorded speech)", default=None, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--chunk-duration", type=float, default=1.0)
+    parser.add_argument("--fps", type=int, help="Agent steps per second", default=5)
+    parser.add_argument("--baseline", type=str, help="Baseline file", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--tolerance", type=float, help="Allowed degradation relative to the baseline", default=0.2)
+    args = parser.parse_args()
+
+    sample_rate = 16000
+    if args.audio is not None:
+        from pcm_cache import PCMCache
+        audio = PCMCache(sample_rate=sample_rate).load_float(args.audio)
+    else:
+        audio = synthetic_speech(args.duration, sample_rate, args.seed)
+
+    agent = Agent(None, stepsPerSecond=args.fps)
+    kit = agent.kit = StandInKit()
+    stream = BenchmarkStream(args.model, sample_rate=sample_rate, duration=args.chunk_duration)
+    if not (args.vad if args.vad is not None else args.audio is not None):
+        stream.vad = AlwaysVoiced()
+    benchmark = LoopBenchmark(agent, stream, kit)
+
+    print("Replaying {:.1f} s of {} speech at {}x...".format(len(audio) / sample_rate, "recorded" if args.audio else "synthetic", args.speed))
+    # The agent and the classifier print at every step.
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = benchmark.run(audio, args.speed)
+
+    print(benchmark.monitor.report())
+    print("throughput: {:.2f} chunks/s, {:.2f} agent ticks/s ({} published, {} dropped, {} lost over OSC, "
+          "{} /action-values lost, {} kit commands)".format(
+        results['chunks_per_second'], results['ticks_per_second'], results['published'], results['dropped'],
+        results['lost_osc'], results['lost_action_values'], results['kit_commands']))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Baseline saved to {}".format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.tolerance)
+        missing = unchecked(results, baseline)
+        if missing:
+            print("Not in the baseline {} (not compared): {}".format(args.baseline, ", ".join(missing)))
+        if found:
+            print("Regressions against {}:".format(args.baseline))
+            for line in found:
+                print("  " + line)
+            sys.exit(1)
+        print("No regression against {}".format(args.baseline))
+    else:
+        print("No baseline: run with --save-baseline to record one")
@@ -0,0 +1,200 @@
+"""Runs the speaker classifier and the agent in a single process.
+
+Instead of two processes linked by /pleasure over UDP, each polling on its own,
+the orchestrator runs every stage in one process:
+
+  audio callback -> [frame ring] -> VAD + buffering -> [chunk ring] -> embedding
+  -> classification -> agent -> kit
+
+Stages hand off through shared-memory ring buffers (pyannote/ring_buffer.py).
+The audio callback only copies the frame into its ring. Everything else runs
+in one scheduler loop that gives the audio path priority:
+  1. VAD and buffering of all captured frames,
+  2. embedding and classification of the oldest queued chunk (or a batch of
+     them, under load), in capture order. Chunks older than --max-latency are
+     dropped, and the chunk ring drops its oldest chunk when full,
+  3. the agent tick, when due. It waits for pending audio unless it is
+     already late by a whole tick period,
+  4. OSC polling of the kit. The loop then sleeps until the next audio
+     frame or agent tick.
+
+With --latency-budget, a LoadController (pyannote/load_control.py) sheds load
+when the budget is exceeded, the chunk ring backs up or agent ticks slip.
+
+The classifier's pleasure is given to the agent directly. Mic-to-motor latency
+(capture of a chunk -> agent tick using its pleasure) is reported on exit, or
+with kill -USR1 <pid>. /profile/start and /profile/stop on the agent's OSC port
+(8001) profile the whole process. Runs in the pyannote environment (plus osc4py3).
+
+    python orchestrator.py --simulation-mode --model ../pyannote/trustnet.pt
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pyannote'))
+from latency import PipelineMonitor, STAGES, capture_time as adc_capture_time
+from load_control import LoadController
+from ring_buffer import RingBuffer
+from speaker_stream import SpeakerStream
+
+from teleo import Agent
+
+# Additional stages: pleasure published -> agent tick, chunk capture -> agent tick, and lateness of ticks.
+ORCHESTRATOR_STAGES = ['agent', 'mic-to-motor', 'tick-lateness']
+
+
+class InProcessSpeakerStream(SpeakerStream):
+    """SpeakerStream whose chunks go through a shared-memory ring and whose pleasure goes straight to an agent."""
+    def __init__(self, agent, *args, **kwargs):
+        super(InProcessSpeakerStream, self).__init__(*args, **kwargs)
+        self.agent = agent
+        self.chunks = RingBuffer(self.queue.maxsize, (self.chunk_samples,), np.float32, n_timestamps=2)
+        self.monitor = PipelineMonitor(STAGES + ORCHESTRATOR_STAGES)
+        # Pleasure not yet used by the agent: (publish time, capture time) of its chunk.
+        self.pending = None
+
+    def enqueue(self, chunk, capture_time, complete_time=None):
+        # Chunks are produced and consumed by the scheduler thread: dropping the oldest is safe.
+        while not self.chunks.write(chunk, capture_time, complete_time or capture_time):
+            self.chunks.drop()
+            self.monitor.drop()
+        self.monitor.record_queue_depth(len(self.chunks))
+
+    def dequeue(self, timeout=0):
+        # Oldest chunk first (FIFO), like SpeakerStream.
+        item = self.chunks.read()
+        if item is None:
+            return None
+        chunk, (capture_time, complete_time) = item
+        return chunk, capture_time, complete_time
+
+    def queue_depth(self):
+        return len(self.chunks)
+
+    def publish(self, pleasure, capture_time):
+        self.agent.receivePleasure([pleasure])
+        self.pending = (time.perf_counter(), capture_time)
+
+
+class Orchestrator:
+    def __init__(self, agent, stream, frame_capacity=256, controller=None):
+        self.agent = agent
+        self.stream = stream
+        self.controller = controller
+        self.monitor = stream.monitor
+        # Frames with their capture and callback times.
+        self.frames = RingBuffer(frame_capacity, (stream.frame_samples,), np.float32, n_timestamps=2)
+        # Set by the audio callback: wakes up the scheduler.
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.next_tick = None
+        self.n_ticks = 0
+
+    @property
+    def period(self):
+        # The load controller may change the agent's steps per second.
+        return 1.0 / self.agent.stepsPerSecond
+
+    def audio_callback(self, indata, frames, time_info, status):
+        capture_time, callback_time = adc_capture_time(time_info)
+        self.monitor.record('capture', capture_time, callback_time)
+        if status and (status.input_overflow or status.input_underflow):
+            self.monitor.xrun()
+        if frames == self.stream.frame_samples and not self.frames.write(indata[:, 0], capture_time, callback_time):
+            # The scheduler fell behind by a whole frame ring: count as an xrun.
+            self.monitor.xrun()
+        self.wake.set()
+
+    def run_audio(self):
+        """VAD and buffering of all captured frames, then the oldest queued chunks through the model. Returns True if a chunk was processed."""
+        while True:
+            item = self.frames.peek()
+            if item is None:
+                break
+            frame, (capture_time, callback_time) = item
+            self.stream.feed(frame, capture_time, callback_time)
+            self.frames.drop()
+        return self.stream.step() is not None
+
+    def tick(self, now):
+        """Agent tick: uses the latest pleasure, updates the agent and sends its state."""
+        self.monitor.record('tick-lateness', self.next_tick, now)
+        if self.controller is not None:
+            self.controller.record_tick(now - self.next_tick, self.period)
+        if self.stream.pending is not None:
+            publish_time, capture_time = self.stream.pending
+            self.monitor.record('agent', publish_time, now)
+            self.monitor.record('mic-to-motor', capture_time, now)
+            self.stream.pending = None
+        self.agent.update()
+        self.agent.sendState()
+        self.n_ticks += 1
+        # Keep the tick rate; after a long stall, restart from now rather than catching up.
+        self.next_tick += self.period
+        if self.next_tick < now:
+            self.next_tick = now + self.period
+
+    def step(self):
+        """One iteration of the scheduler."""
+        processed = self.run_audio()
+        now = time.perf_counter()
+        if now >= self.next_tick and (len(self.frames) == 0 or now - self.next_tick >= self.period):
+            self.tick(now)
+        self.agent.poll()
+        if self.controller is not None:
+            self.controller.update(now)
+        if not processed and len(self.frames) == 0 and len(self.stream.chunks) == 0:
+            self.wake.wait(max(0.0, min(self.next_tick - time.perf_counter(), self.period)))
+            self.wake.clear()
+
+    def run(self):
+        import sounddevice as sd
+        self.monitor.install_signal_handler()
+        self.agent.start()
+        self.next_tick = time.perf_counter() + self.period
+        with sd.InputStream(samplerate=self.stream.sample_rate, channels=1, callback=self.audio_callback,
+                            blocksize=self.stream.frame_samples):
+            print("Running. Press Ctrl+C to stop.")
+            try:
+                while not self.stop_event.is_set():
+                    self.step()
+            except KeyboardInterrupt:
+                print("Stopping.")
+        print(self.stream.latency_report())
+        print(self.monitor.report())
+
+    def close(self):
+        self.frames.close()
+        self.stream.chunks.close()
+        self.agent.terminate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--kit-id", type=int, help="ID of the kit to run", default=0)
+    parser.add_argument("--simulation-mode", help="Simulation mode (no MisBKit)", default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--fps", type=int, help="Number of agent steps per second", default=5)
+    parser.add_argument("--model", type=str, help="Trustnet model filename", default="trustnet.pt")
+    parser.add_argument("--speaker-pleasure", type=float, nargs="+", help="Pleasure for each speaker class", default=None)
+    parser.add_argument("--duration", type=float, help="Duration of voiced audio per chunk in seconds", default=1.0)
+    parser.add_argument("--max-latency", type=float, help="Maximum capture-to-classification latency in seconds", default=1.0)
+    parser.add_argument("--checkpoint", type=str, help="Checkpoint file of the agent state (none to disable)", default="agent_checkpoint.json")
+    parser.add_argument("--resume", help="Resume the agent from its checkpoint if it exists", default=True, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--latency-budget", type=float, help="Shed load above this capture-to-classification latency (seconds)", default=None)
+    args = parser.parse_args()
+
+    kitId = args.kit_id if not args.simulation_mode else None
+    agent = Agent(kitId, stepsPerSecond=args.fps, checkpointFile=args.checkpoint if args.checkpoint != "none" else None,
+                  resume=args.resume)
+    stream = InProcessSpeakerStream(agent, args.model, args.speaker_pleasure, duration=args.duration, max_latency=args.max_latency)
+    controller = LoadController(stream, agent, args.latency_budget) if args.latency_budget is not None else None
+    orchestrator = Orchestrator(agent, stream, controller=controller)
+    try:
+        orchestrator.run()
+    finally:
+        orchestrator.close()
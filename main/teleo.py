@@ -2,8 +2,19 @@ import numpy as np
 from enum import IntEnum
 import signal
 import argparse
+import json
+import os
+import sys
+import threading
+import time
 from messaging import *
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pyannote'))
+from sampling_profiler import SamplingProfiler
+
+# Version of the checkpoint format (see Agent.saveCheckpoint()).
+CHECKPOINT_VERSION = 1
+
 class AgentState(IntEnum):
   CLOSED   = 0
   OPENED   = 1  
@@ -18,8 +29,23 @@ class AgentAction(IntEnum):
   N_ACTIONS = 2
 
 class Agent:
-  def __init__(self, kitId = None, stepsPerSecond = 5):
+  def __init__(self, kitId = None, stepsPerSecond = 5, checkpointFile = None, checkpointInterval = 5.0, resume = True,
+               pairingMaxAge = 600.0, pairingTimeout = 2.0):
     self.stepsPerSecond = stepsPerSecond
+    # State is saved to checkpointFile every checkpointInterval seconds and restored from it on start (if resume).
+    self.checkpointFile = checkpointFile
+    self.checkpointInterval = checkpointInterval
+    self.lastCheckpoint = time.time()
+    # Checkpoints are written by a background thread, off the tick.
+    self.checkpointWriter = None
+    # Kit pairing info older than pairingMaxAge seconds is not restored. Restored pairing is checked
+    # with /isPaired: without a positive reply within pairingTimeout seconds, the kit is paired again.
+    self.pairingMaxAge = pairingMaxAge
+    self.pairingTimeout = pairingTimeout
+    self.pairingCheckTime = None
+    self.repairKit = False
+    # Print state and decisions at every step (turned off under load, see pyannote/load_control.py).
+    self.verbose = True
 
     if kitId is None:
       self.kit = None
@@ -28,6 +54,11 @@ class Agent:
 
     self.oscHelper = OscHelper("teleo-agent", "localhost", send_port=8000, recv_port=8001)
     self.oscHelper.map("/pleasure", self.receivePleasure)
+    # Sampling profiler of the whole process, toggled at runtime (writes profiles/agent-*.folded).
+    self.profiler = SamplingProfiler("agent")
+    self.oscHelper.map("/profile/start", lambda data: self.profiler.start())
+    # Stopping joins the sampler and writes the file: done in the background, off the tick.
+    self.oscHelper.map("/profile/stop", lambda data: self.profiler.stop(background=True))
     # self.oscHelper.map("/trust", self.receiveTrust)
 
     self.learningRate = 0.1
@@ -36,10 +67,10 @@ class Agent:
     self.rewardWeightAction = 0.4
     self.rewardWeightTrust  = 0.3
 
-    self.initialize()
+    self.initialize(resume)
 
-  # Initialize the agent.
-  def initialize(self):
+  # Initialize the agent, or restore it from its checkpoint.
+  def initialize(self, resume = False):
     # Init properties.
     self.happiness = 0
     self.curiosity = 0
@@ -49,18 +80,142 @@ class Agent:
     # Starting state.
     self.state = AgentState.CLOSED
     self.currentPleasure = 0 # latest registered pleasure
-    # Start comm with MisBKit.
-    if self.kit is not None:
+    # Restore learned state (and kit pairing) after a restart.
+    self.resumed = resume and self.loadCheckpoint()
+    if self.kit is None:
+      return
+    if self.resumed and self.kit.is_paired and self.kit.motor_ids is not None:
+      # Paired before the restart: check that it still is (the kit may have been power-cycled) without
+      # blocking, and pair again from poll() if not.
+      self.kit.osc_helper.map("/isPaired", self.receiveIsPaired)
+      self.pairingCheckTime = time.time()
+      self.kit.isPaired()
+    else:
+      # Start comm with MisBKit.
+      self.kit.begin()
+
+  def receiveIsPaired(self, data):
+    self.kit.receive_is_paired(data)
+    if self.pairingCheckTime is None:
+      return
+    self.pairingCheckTime = None
+    if not (len(data) > 0 and data[0]):
+      print("Kit {} is no longer paired".format(self.kit.id))
+      self.repairKit = True
+
+  # Pairs the kit again if the check of its restored pairing failed or timed out.
+  def checkPairing(self):
+    if self.pairingCheckTime is not None and time.time() - self.pairingCheckTime > self.pairingTimeout:
+      print("Kit {} did not confirm its pairing".format(self.kit.id))
+      self.pairingCheckTime = None
+      self.repairKit = True
+    if self.repairKit:
+      self.repairKit = False
+      self.kit.is_paired = None
+      self.kit.motor_ids = None
       self.kit.begin()
 
   def terminate(self):
+    self.profiler.stop()
+    if self.checkpointWriter is not None:
+      self.checkpointWriter.join()
+    self.saveCheckpoint()
     if self.kit is not None:
       self.kit.terminate()
 
   def start(self):
-    self.close() # start closed
-
+    if not self.resumed:
+      self.close() # start closed
+
+  # Saves the learned state and the kit's pairing info. The file is replaced atomically: a crash
+  # while saving leaves the previous checkpoint intact.
+  def saveCheckpoint(self):
+    if self.checkpointFile is None:
+      return
+    self.writeCheckpoint(self.checkpointState())
+    self.lastCheckpoint = time.time()
+
+  # Snapshot of the state to checkpoint (cheap: called on the tick).
+  def checkpointState(self):
+    checkpoint = {
+      "version": CHECKPOINT_VERSION,
+      "time": time.time(),
+      "trust": float(self.trust),
+      "happiness": float(self.happiness),
+      "curiosity": float(self.curiosity),
+      "stateValues": self.stateValues.tolist(),
+      "state": int(self.state),
+    }
+    if self.kit is not None:
+      checkpoint["kit"] = { "id": self.kit.id, "is_paired": self.kit.is_paired, "motor_ids": self.kit.motor_ids }
+    return checkpoint
+
+  def writeCheckpoint(self, checkpoint):
+    tmpFile = self.checkpointFile + ".tmp"
+    with open(tmpFile, "w") as f:
+      json.dump(checkpoint, f, separators=(",", ":"))
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmpFile, self.checkpointFile)
+
+  # Restores the state saved by saveCheckpoint(). Returns False if there is no usable checkpoint, in
+  # which case nothing is restored.
+  def loadCheckpoint(self):
+    if self.checkpointFile is None or not os.path.exists(self.checkpointFile):
+      return False
+    try:
+      with open(self.checkpointFile) as f:
+        checkpoint = json.load(f)
+      if checkpoint["version"] != CHECKPOINT_VERSION:
+        print("Ignoring checkpoint {}: version {}".format(self.checkpointFile, checkpoint["version"]))
+        return False
+      # Parse and validate everything before touching the agent.
+      savedTime   = float(checkpoint["time"])
+      trust       = float(checkpoint["trust"])
+      happiness   = float(checkpoint["happiness"])
+      curiosity   = float(checkpoint["curiosity"])
+      stateValues = np.array(checkpoint["stateValues"], dtype=self.stateValues.dtype)
+      if stateValues.shape != self.stateValues.shape:
+        raise ValueError("expected {} state values, got {}".format(len(self.stateValues), stateValues.size))
+      state       = AgentState(checkpoint["state"])
+      kit         = checkpoint.get("kit")
+      if kit is not None:
+        kit = { "id": kit["id"], "is_paired": kit["is_paired"], "motor_ids": kit["motor_ids"] }
+    except (OSError, ValueError, KeyError, TypeError) as e:
+      print("Ignoring checkpoint {}: {}".format(self.checkpointFile, e))
+      return False
+    self.trust       = trust
+    self.happiness   = happiness
+    self.curiosity   = curiosity
+    self.stateValues = stateValues
+    self.state       = state
+    # Pairing info is only valid for the same kit, and only for a while.
+    age = time.time() - savedTime
+    if self.kit is not None and kit is not None and kit["id"] == self.kit.id and age <= self.pairingMaxAge:
+      self.kit.is_paired = kit["is_paired"]
+      self.kit.motor_ids = kit["motor_ids"]
+    print("Resumed from checkpoint {} saved {:.1f} s ago".format(self.checkpointFile, age))
+    return True
+
+  # Takes a snapshot of the state on the tick and writes it from a background thread (fsync can stall
+  # for tens of milliseconds on SD cards). A checkpoint is skipped while the previous one is being written.
+  def checkpointIfDue(self):
+    if self.checkpointFile is None or time.time() - self.lastCheckpoint < self.checkpointInterval:
+      return
+    if self.checkpointWriter is not None and self.checkpointWriter.is_alive():
+      return
+    self.checkpointWriter = threading.Thread(target=self.writeCheckpoint, args=(self.checkpointState(),),
+                                             name="checkpoint", daemon=True)
+    self.checkpointWriter.start()
+    self.lastCheckpoint = time.time()
+
+  # Updates the agent then waits for the next step, processing OSC messages meanwhile.
   def step(self):
+    self.update()
+    self.wait(1.0 / self.stepsPerSecond)
+
+  # One tick of the agent: reads pleasure, updates its internal state and takes a decision (does not wait).
+  def update(self):
     self.debug()
 
     # Current instantaneous pleasure.
@@ -104,7 +259,8 @@ class Agent:
       #   self.open()
 
     # Update.
-    print(" pleasure: " + str(reward))
+    if self.verbose:
+      print(" pleasure: " + str(reward))
     self.addHappiness(reward)
     self.updateStateValue(reward)
 
@@ -121,12 +277,20 @@ class Agent:
     # else:
     #   self.addCuriosity(0.1)
 
-    # Wait.
+    # Save state periodically, so that a restart resumes from here.
+    self.checkpointIfDue()
+
+  # Processes pending OSC messages from the kit and the speaker classifier, without blocking.
+  def poll(self):
+    if self.kit is not None:
+      self.kit.loop()
+      self.checkPairing()
+    self.oscHelper.loop()
+
+  def wait(self, duration):
     startTime = time.time()
-    while time.time() - startTime < (1.0 / self.stepsPerSecond):
-      if self.kit is not None:
-        self.kit.loop()
-      self.oscHelper.loop()
+    while time.time() - startTime < duration:
+      self.poll()
 
   # For now this returns a value between -1 and +1 representing the agent's instantaneous pleasure or pain.
   def pleasure(self):
@@ -155,7 +319,8 @@ class Agent:
     self.oscHelper.send_message("/action-values", values)
 
     values = np.array(values)
-    print("Values: " + str(values)) 
+    if self.verbose:
+      print("Values: " + str(values))
 
     # Choose action.
     return np.argmax(values)
@@ -205,6 +370,8 @@ class Agent:
     })
 
   def debug(self):
+    if not self.verbose:
+      return
     print("AGENT =====================")
     print("trust: " + str(self.trust))
     print("happiness: " + str(self.happiness))
@@ -258,12 +425,19 @@ if __name__ == '__main__':
     parser.add_argument("--kit-id", type=int, help="ID of the kit to run", default=0)
     parser.add_argument("--simulation-mode", type=bool, help="Simulation mode (no MisBKit)", default=False, action=argparse.BooleanOptionalAction)
     parser.add_argument("--fps", type=int, help="Number of steps per second", default=5)
+    parser.add_argument("--checkpoint", type=str, help="Checkpoint file of the agent state (none to disable)", default="agent_checkpoint.json")
+    parser.add_argument("--checkpoint-interval", type=float, help="Seconds between checkpoints", default=5.0)
+    parser.add_argument("--resume", help="Resume from the checkpoint if it exists", default=True, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--pairing-max-age", type=float, help="Seconds after which the kit pairing of a checkpoint is not restored", default=600.0)
 
     # Parse arguments.
     args = parser.parse_args()
 
     kitId = args.kit_id if not args.simulation_mode else None
-    agent = Agent(kitId, stepsPerSecond = args.fps)
+    checkpointFile = args.checkpoint if args.checkpoint != "none" else None
+    agent = Agent(kitId, stepsPerSecond = args.fps, checkpointFile = checkpointFile,
+                  checkpointInterval = args.checkpoint_interval, resume = args.resume,
+                  pairingMaxAge = args.pairing_max_age)
 
     # run_settings = yaml.load(open(args.run_file, 'r'), Loader=yaml.SafeLoader)
     # settings = yaml.load(open(args.settings_file, 'r'), Loader=yaml.SafeLoader)
@@ -0,0 +1,158 @@
+"""Speaker embedding backends.
+
+Every backend turns equal-length chunks of mono audio at its sample rate into
+fixed-size speaker embeddings, and declares the dimension of its embeddings so
+that trustnet can be built without loading the embedding model. The revision of
+the model weights (see model_revision()) identifies cached embeddings.
+
+  pyannote  pyannote/embedding (pyannote.audio)
+  malaya    malaya-speech speaker vector models (vggvox-v2 by default)
+
+    backend = get_backend("malaya")
+    embeddings = backend.embed(chunks)   # chunks: (N, samples) float32 -> (N, backend.dim)
+"""
+import abc
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+HUGGING_FACE_AUTH_TOKEN=""
+
+
+class EmbeddingBackend(abc.ABC):
+    name = None
+    dim = None
+    sample_rate = 16000
+    revision = None
+
+    @abc.abstractmethod
+    def embed(self, chunks):
+        """Embeddings of (N, samples) float32 chunks, as an (N, dim) float32 array."""
+
+    def embed_file(self, path):
+        """Embedding of a whole audio file, as a (dim,) float32 array."""
+        import librosa
+        audio, sr = librosa.load(path, sr=self.sample_rate)
+        return self.embed(audio[np.newaxis])[0]
+
+    def description(self):
+        return { 'backend': self.name, 'dim': self.dim, 'sample_rate': self.sample_rate, 'revision': self.revision }
+
+
+class PyannoteBackend(EmbeddingBackend):
+    name = "pyannote"
+    dim = 512
+
+    def __init__(self, checkpoint="pyannote/embedding", device=None):
+        import torch
+        from pyannote.audio import Model, Inference
+        self.torch = torch
+        self.checkpoint = checkpoint
+        self.revision = model_revision(self.name, checkpoint)
+        self.device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+        self.model = Model.from_pretrained(checkpoint, use_auth_token=HUGGING_FACE_AUTH_TOKEN)
+        self.model.eval()
+        self.model.to(self.device)
+        self.inference = Inference(self.model, window="whole", device=self.device)
+        self.sample_rate = self.model.audio.sample_rate
+        self.lock = threading.Lock()
+
+    def embed(self, chunks, sample_rate=None):
+        # Chunks all have the same length: run them through the model in a single forward pass.
+        chunks = np.ascontiguousarray(chunks, dtype=np.float32)
+        with self.lock, self.torch.inference_mode():
+            waveforms = self.torch.from_numpy(chunks).unsqueeze(1)
+            if sample_rate is not None and sample_rate != self.sample_rate:
+                # Inference resamples to the sample rate of the model.
+                embeddings = np.stack([self.inference({'waveform': w, 'sample_rate': sample_rate}) for w in waveforms])
+            else:
+                embeddings = self.model(waveforms.to(self.device)).cpu().numpy()
+        return embeddings.astype(np.float32)
+
+    def embed_file(self, path):
+        with self.lock:
+            return np.asarray(self.inference(path), dtype=np.float32)
+
+    def description(self):
+        return dict(super(PyannoteBackend, self).description(), model=self.checkpoint)
+
+
+class MalayaBackend(EmbeddingBackend):
+    name = "malaya"
+    # Dimension of the malaya-speech speaker vector models.
+    dims = { 'vggvox-v1': 1024, 'vggvox-v2': 512, 'deep-speaker': 512, 'speakernet': 192 }
+
+    def __init__(self, model="vggvox-v2", quantized=False):
+        import malaya_speech
+        self.model_name = model
+        self.revision = model_revision(self.name, model, quantized)
+        self.model = malaya_speech.speaker_vector.deep_model(model, quantized=quantized)
+        self.lock = threading.Lock()
+        # Models with an unknown dimension are probed once with a second of silence.
+        self.dim = self.dims[model] if model in self.dims else self.embed(np.zeros((1, self.sample_rate), dtype=np.float32)).shape[1]
+
+    def embed(self, chunks):
+        with self.lock:
+            return np.asarray(self.model([np.asarray(chunk, dtype=np.float32) for chunk in chunks]), dtype=np.float32)
+
+    def embed_file(self, path):
+        import malaya_speech
+        return self.embed([malaya_speech.load(path)[0]])[0]
+
+    def description(self):
+        return dict(super(MalayaBackend, self).description(), model=self.model_name)
+
+
+BACKENDS = { backend.name: backend for backend in [PyannoteBackend, MalayaBackend] }
+
+
+def get_backend(name="pyannote", **kwargs):
+    """Loads the embedding backend with the given name."""
+    if name not in BACKENDS:
+        raise ValueError("Unknown embedding backend {} (available: {})".format(name, ", ".join(BACKENDS)))
+    return BACKENDS[name](**kwargs)
+
+
+def checkpoint_revision(checkpoint):
+    """Revision of a pyannote checkpoint: hash of a local file, or commit of the local Hugging Face snapshot.
+
+    Never queries the Hub: a model that has not been downloaded yet is identified by its name only.
+    """
+    if os.path.isfile(checkpoint):
+        h = hashlib.sha256()
+        with open(checkpoint, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return "{}@{}".format(os.path.abspath(checkpoint), h.hexdigest())
+    try:
+        from huggingface_hub import try_to_load_from_cache
+    except ImportError:
+        return checkpoint
+    # Cached snapshots are stored under .../snapshots/<commit>/.
+    path = try_to_load_from_cache(checkpoint, "pytorch_model.bin")
+    if isinstance(path, str):
+        return "{}@{}".format(checkpoint, os.path.basename(os.path.dirname(path)))
+    return checkpoint
+
+
+def model_revision(name="pyannote", model=None, quantized=False):
+    """Revision of the weights a backend loads, without loading them."""
+    if name == PyannoteBackend.name:
+        return checkpoint_revision(model or "pyannote/embedding")
+    if name == MalayaBackend.name:
+        from importlib import metadata
+        try:
+            version = metadata.version("malaya-speech")
+        except metadata.PackageNotFoundError:
+            version = "unknown"
+        return "{}{}@malaya-speech=={}".format(model or "vggvox-v2", "-quantized" if quantized else "", version)
+    raise ValueError("Unknown embedding backend {} (available: {})".format(name, ", ".join(BACKENDS)))
+
+
+def embedding_dim(name="pyannote", model=None):
+    """Declared embedding dimension of a backend, without loading it."""
+    if name == MalayaBackend.name:
+        return MalayaBackend.dims[model or "vggvox-v2"]
+    return BACKENDS[name].dim
@@ -0,0 +1,73 @@
+"""Compares embedding backends on the same audio.
+
+For each backend, embeds the voiced chunks of the training recordings and reports:
+  - load time of the model,
+  - real-time factor (processing time / audio duration, lower is faster),
+  - speaker identification accuracy: speakers are enrolled in a SpeakerIndex from the first part of
+    their recording and the chunks of the remaining part are identified.
+
+    python embedding_benchmark.py --backends pyannote malaya
+"""
+import argparse
+import time
+
+import numpy as np
+
+from embedding_backends import get_backend
+from speaker_dataset import load_voiced_chunks
+from speaker_index import SpeakerIndex
+
+speakers = ['1-Victor', '2-Sofian', '3-Etienne', '4-Natalia']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--backends", type=str, nargs="+", default=["pyannote", "malaya"])
+    parser.add_argument("--chunk-duration", type=float, default=1.0)
+    parser.add_argument("--enroll-fraction", type=float, help="Fraction of each recording used for enrollment", default=0.7)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--vad-mode", type=int, default=3)
+    args = parser.parse_args()
+
+    sample_rate = 16000
+    file_paths = [ "./Voices/VOIX TELEO " + s + ".wav" for s in speakers ]
+    chunks = [load_voiced_chunks(f, sample_rate, args.chunk_duration, args.vad_mode) for f in file_paths]
+    audio_seconds = sum(len(c) for c in chunks) * args.chunk_duration
+    print("{} chunks of {} s ({:.0f} s of voiced audio)".format(sum(len(c) for c in chunks), args.chunk_duration, audio_seconds))
+
+    results = []
+    for name in args.backends:
+        try:
+            startTime = time.perf_counter()
+            backend = get_backend(name)
+            load_time = time.perf_counter() - startTime
+        except ImportError as e:
+            print("Skipping {} backend: {}".format(name, e))
+            continue
+        if backend.sample_rate != sample_rate:
+            print("Skipping {} backend: expects {} Hz audio".format(name, backend.sample_rate))
+            continue
+
+        backend.embed(chunks[0][:1])  # warm up
+        embeddings = []
+        startTime = time.perf_counter()
+        for speaker_chunks in chunks:
+            embeddings.append(np.concatenate([backend.embed(speaker_chunks[i:i + args.batch_size])
+                                              for i in range(0, len(speaker_chunks), args.batch_size)]))
+        rtf = (time.perf_counter() - startTime) / audio_seconds
+
+        index = SpeakerIndex(dim=embeddings[0].shape[1], threshold=-1)
+        test_embeddings, test_names = [], []
+        for speaker, speaker_embeddings in zip(speakers, embeddings):
+            n = int(args.enroll_fraction * len(speaker_embeddings))
+            index.enroll(speaker, speaker_embeddings[:n])
+            test_embeddings.append(speaker_embeddings[n:])
+            test_names += [speaker] * (len(speaker_embeddings) - n)
+        predicted, scores = index.identify_batch(np.concatenate(test_embeddings))
+        accuracy = np.mean([p == t for p, t in zip(predicted, test_names)])
+        results.append((name, backend.dim, load_time, rtf, accuracy))
+
+    print()
+    print("{:10s} {:>6s} {:>12s} {:>10s} {:>10s}".format("backend", "dim", "load (s)", "RTF", "accuracy"))
+    for name, dim, load_time, rtf, accuracy in results:
+        print("{:10s} {:6d} {:12.2f} {:10.4f} {:9.1f}%".format(name, dim, load_time, rtf, 100 * accuracy))
@@ -0,0 +1,60 @@
+"""Content-addressed on-disk cache of embeddings.
+
+Embeddings of an audio file are stored as a .npy array under a key computed
+from the hash of the file contents and the preprocessing parameters (sample
+rate, VAD mode, chunk duration, embedding model revision...). Arrays are loaded
+memory-mapped, so a cache hit costs almost nothing. Changing the audio or any
+parameter changes the key, so stale entries are never used.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = "embedding_cache"
+
+
+def file_hash(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        # File hashes, memoized by (path, size, modification time) for the lifetime of the cache object.
+        self.hashes = {}
+
+    def key(self, path, **params):
+        """Key of the embeddings of the audio file at path computed with the given parameters."""
+        stat = os.stat(path)
+        memo = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if memo not in self.hashes:
+            self.hashes[memo] = file_hash(path)
+        description = json.dumps({ 'audio': self.hashes[memo], **params }, sort_keys=True)
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def load(self, key):
+        """Returns the cached (memory-mapped) array, or None if it is not in the cache."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode="r")
+
+    def save(self, key, array):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so that an interrupted run never leaves a truncated entry.
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(array, dtype=np.float32))
+        os.replace(tmp_path, path)
+        return self.load(key)
@@ -0,0 +1,239 @@
+"""Long-lived embedding service.
+
+Loads an embedding model (see embedding_backends.py) once and answers embedding
+requests over a Unix socket, so that client scripts start without paying the
+model loading cost.
+
+Start the service:
+
+    python embedding_service.py                     # pyannote/embedding
+    python embedding_service.py --backend malaya    # malaya-speech vggvox-v2
+
+Then, from any script:
+
+    from embedding_service import load_embedder
+    embed, embed_file = load_embedder()
+    embedding = embed(waveform)            # waveform: 1D float array at 16 kHz
+    embedding = embed_file("voice.wav")
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import time
+
+import numpy as np
+
+from embedding_backends import get_backend, model_revision, PyannoteBackend
+
+DEFAULT_SOCKET_PATH = "/tmp/teleo-embedding.sock"
+DEFAULT_SAMPLE_RATE = 16000
+
+# Request: opcode (1 byte) followed by a payload.
+#  - OP_WAVEFORM: sample rate, number of chunks, samples per chunk (uint32) then float32 samples.
+#  - OP_FILE: path length (uint32) then utf-8 encoded path.
+#  - OP_INFO: no payload.
+# Response: status (1 byte), number of embeddings and dimension (uint32) then float32 embeddings.
+# The response to OP_INFO is a utf-8 JSON description of the backend prefixed by its length.
+# On error the status is STATUS_ERROR and the payload is a utf-8 message prefixed by its length.
+OP_WAVEFORM = b"W"
+OP_FILE = b"F"
+OP_INFO = b"I"
+STATUS_OK = b"\x00"
+STATUS_ERROR = b"\x01"
+
+WAVEFORM_HEADER = struct.Struct("<III")
+LENGTH_HEADER = struct.Struct("<I")
+EMBEDDING_HEADER = struct.Struct("<II")
+
+
+def _recv_exactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        packet = sock.recv(n - len(data))
+        if not packet:
+            raise ConnectionError("Connection closed by peer")
+        data.extend(packet)
+    return bytes(data)
+
+
+class EmbeddingRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # A connection stays open for any number of requests.
+        while True:
+            try:
+                op = self.request.recv(1)
+            except ConnectionError:
+                return
+            if not op:
+                return
+            try:
+                if op == OP_INFO:
+                    message = json.dumps(self.server.backend.description()).encode("utf-8")
+                    self.request.sendall(STATUS_OK + LENGTH_HEADER.pack(len(message)) + message)
+                    continue
+                embeddings = self.process(op)
+            except ConnectionError:
+                return
+            except Exception as e:
+                message = str(e).encode("utf-8")
+                self.request.sendall(STATUS_ERROR + LENGTH_HEADER.pack(len(message)) + message)
+                continue
+            self.request.sendall(STATUS_OK + EMBEDDING_HEADER.pack(*embeddings.shape) + embeddings.tobytes())
+
+    def process(self, op):
+        backend = self.server.backend
+        if op == OP_WAVEFORM:
+            sample_rate, n_chunks, n_samples = WAVEFORM_HEADER.unpack(_recv_exactly(self.request, WAVEFORM_HEADER.size))
+            data = _recv_exactly(self.request, 4 * n_chunks * n_samples)
+            chunks = np.frombuffer(data, dtype=np.float32).reshape(n_chunks, n_samples)
+            return embed_chunks(backend, chunks, sample_rate)
+        elif op == OP_FILE:
+            (length,) = LENGTH_HEADER.unpack(_recv_exactly(self.request, LENGTH_HEADER.size))
+            path = _recv_exactly(self.request, length).decode("utf-8")
+            return backend.embed_file(path)[np.newaxis]
+        else:
+            raise ValueError("Unknown opcode {!r}".format(op))
+
+
+def embed_chunks(backend, chunks, sample_rate):
+    if sample_rate == backend.sample_rate:
+        return backend.embed(chunks)
+    if isinstance(backend, PyannoteBackend):
+        return backend.embed(chunks, sample_rate)
+    raise ValueError("The {} backend expects audio at {} Hz, got {} Hz".format(backend.name, backend.sample_rate, sample_rate))
+
+
+class EmbeddingServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, backend):
+        self.backend = backend
+        if os.path.exists(socket_path):
+            # Only remove a stale socket, never the socket of a running service.
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except ConnectionRefusedError:
+                os.unlink(socket_path)
+            else:
+                raise RuntimeError("Embedding service already running at {}".format(socket_path))
+            finally:
+                probe.close()
+        super(EmbeddingServer, self).__init__(socket_path, EmbeddingRequestHandler)
+
+
+class EmbeddingClient:
+    """Client for the embedding service. Connecting takes a few milliseconds."""
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+
+    def embed(self, waveform, sample_rate=DEFAULT_SAMPLE_RATE):
+        """Embeds a 1D waveform (returns a (D,) array) or a 2D batch of equal-length chunks (returns (N, D))."""
+        chunks = np.ascontiguousarray(waveform, dtype=np.float32)
+        single = chunks.ndim == 1
+        if single:
+            chunks = chunks[np.newaxis]
+        self.sock.sendall(OP_WAVEFORM + WAVEFORM_HEADER.pack(sample_rate, *chunks.shape) + chunks.tobytes())
+        embeddings = self._receive()
+        return embeddings[0] if single else embeddings
+
+    def embed_file(self, path):
+        """Embeds a whole audio file, read by the service. Returns a (D,) array."""
+        path = os.path.abspath(path).encode("utf-8")
+        self.sock.sendall(OP_FILE + LENGTH_HEADER.pack(len(path)) + path)
+        return self._receive()[0]
+
+    def info(self):
+        """Description of the backend of the service (name, embedding dimension, sample rate...)."""
+        self.sock.sendall(OP_INFO)
+        self._check_status()
+        (length,) = LENGTH_HEADER.unpack(_recv_exactly(self.sock, LENGTH_HEADER.size))
+        return json.loads(_recv_exactly(self.sock, length).decode("utf-8"))
+
+    def _check_status(self):
+        status = _recv_exactly(self.sock, 1)
+        if status == STATUS_ERROR:
+            (length,) = LENGTH_HEADER.unpack(_recv_exactly(self.sock, LENGTH_HEADER.size))
+            raise RuntimeError("Embedding service error: " + _recv_exactly(self.sock, length).decode("utf-8"))
+
+    def _receive(self):
+        self._check_status()
+        n, dim = EMBEDDING_HEADER.unpack(_recv_exactly(self.sock, EMBEDDING_HEADER.size))
+        data = _recv_exactly(self.sock, 4 * n * dim)
+        return np.frombuffer(data, dtype=np.float32).reshape(n, dim)
+
+    def close(self):
+        self.sock.close()
+
+
+def load_embedder(socket_path=DEFAULT_SOCKET_PATH, sample_rate=DEFAULT_SAMPLE_RATE, backend="pyannote"):
+    """Returns (embed, embed_file) functions.
+
+    Uses the embedding service if it is running with the requested backend, otherwise falls back to
+    loading the backend in-process.
+    """
+    try:
+        client = EmbeddingClient(socket_path)
+        if client.info()['backend'] == backend:
+            print("Using embedding service at {}".format(socket_path))
+            return (lambda waveform: client.embed(waveform, sample_rate)), client.embed_file
+        client.close()
+        print("Embedding service does not run the {} backend".format(backend))
+    except (FileNotFoundError, ConnectionRefusedError):
+        print("Embedding service not available")
+    print("Loading the {} embedding backend in-process".format(backend))
+    model = get_backend(backend)
+    def embed(waveform):
+        chunks = np.ascontiguousarray(waveform, dtype=np.float32)
+        embeddings = embed_chunks(model, chunks if chunks.ndim == 2 else chunks[np.newaxis], sample_rate)
+        return embeddings if chunks.ndim == 2 else embeddings[0]
+    return embed, model.embed_file
+
+
+def embedding_revision(socket_path=DEFAULT_SOCKET_PATH, backend="pyannote"):
+    """Revision of the model load_embedder() would use: the service's if it runs the backend, else the default."""
+    try:
+        client = EmbeddingClient(socket_path)
+        try:
+            info = client.info()
+        finally:
+            client.close()
+        if info['backend'] == backend and info.get('revision') is not None:
+            return info['revision']
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass
+    return model_revision(backend)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--socket", type=str, help="Path of the Unix socket", default=DEFAULT_SOCKET_PATH)
+    parser.add_argument("--backend", type=str, help="Embedding backend (pyannote or malaya)", default="pyannote")
+    parser.add_argument("--checkpoint", type=str, help="Pretrained pyannote embedding model", default="pyannote/embedding")
+    parser.add_argument("--device", type=str, help="Torch device for pyannote (default: cuda if available)", default=None)
+    parser.add_argument("--malaya-model", type=str, help="Malaya speaker vector model", default="vggvox-v2")
+    args = parser.parse_args()
+
+    startTime = time.time()
+    if args.backend == "pyannote":
+        backend = get_backend(args.backend, checkpoint=args.checkpoint, device=args.device)
+    elif args.backend == "malaya":
+        backend = get_backend(args.backend, model=args.malaya_model)
+    else:
+        backend = get_backend(args.backend)
+    print("Model loaded in {:.2f} s".format(time.time() - startTime))
+
+    server = EmbeddingServer(args.socket, backend)
+    print("Embedding service listening on {}. Press Ctrl+C to stop.".format(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping embedding service.")
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
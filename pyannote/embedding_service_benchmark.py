@@ -0,0 +1,60 @@
+"""Compares cold and warm embedding latency.
+
+Cold: load the model in-process and compute a first embedding (what every script used to do at startup).
+Warm: connect to the running embedding service and compute embeddings through it.
+
+Start the service first (python embedding_service.py), then run:
+
+    python embedding_service_benchmark.py
+"""
+import argparse
+import time
+
+import numpy as np
+
+from embedding_backends import get_backend
+from embedding_service import EmbeddingClient, DEFAULT_SOCKET_PATH, DEFAULT_SAMPLE_RATE
+
+
+def percentiles(times):
+    times = np.asarray(times) * 1000
+    return "p50 = {:8.2f} ms  p95 = {:8.2f} ms  max = {:8.2f} ms".format(
+        np.percentile(times, 50), np.percentile(times, 95), times.max())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--socket", type=str, help="Path of the Unix socket", default=DEFAULT_SOCKET_PATH)
+    parser.add_argument("--duration", type=float, help="Duration of the test chunk in seconds", default=1.0)
+    parser.add_argument("--n-requests", type=int, help="Number of warm requests", default=100)
+    parser.add_argument("--backend", type=str, help="Embedding backend for the cold measurement", default="pyannote")
+    parser.add_argument("--skip-cold", default=False, action=argparse.BooleanOptionalAction)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    waveform = rng.uniform(-0.5, 0.5, int(DEFAULT_SAMPLE_RATE * args.duration)).astype(np.float32)
+
+    if not args.skip_cold:
+        startTime = time.perf_counter()
+        model = get_backend(args.backend)
+        loadTime = time.perf_counter() - startTime
+        model.embed(waveform[np.newaxis])
+        coldTime = time.perf_counter() - startTime
+        print("Cold: model load = {:.2f} s, first embedding = {:.2f} s".format(loadTime, coldTime))
+        del model
+
+    startTime = time.perf_counter()
+    client = EmbeddingClient(args.socket)
+    connectTime = time.perf_counter() - startTime
+    first = client.embed(waveform)
+    firstTime = time.perf_counter() - startTime
+    print("Warm: connect = {:.2f} ms, first embedding = {:.2f} ms (dim = {})".format(
+        connectTime * 1000, firstTime * 1000, first.shape[0]))
+
+    times = []
+    for i in range(args.n_requests):
+        startTime = time.perf_counter()
+        client.embed(waveform)
+        times.append(time.perf_counter() - startTime)
+    print("Warm requests ({}): {}".format(args.n_requests, percentiles(times)))
+    client.close()
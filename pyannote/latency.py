@@ -0,0 +1,140 @@
+"""Per-stage latency instrumentation for the audio pipeline.
+
+Each stage has its own histogram with log-spaced bins. Histograms are written
+by a single thread each (the audio callback or the inference loop) and read by
+the reporter without locks: recording is a bin index computation and an integer
+increment on preallocated arrays. The drop and queue depth counters are updated
+from both threads and take a lock.
+
+Stages (durations between consecutive timestamps of a chunk):
+  capture         ADC -> audio callback (driver latency)
+  vad             audio callback -> VAD decision
+  buffer          first voiced frame -> chunk complete (accumulation)
+  queue           chunk complete -> dequeue by the inference loop
+  embedding       dequeue -> embedding computed
+  classification  embedding computed -> classification done
+  total           last frame captured -> classification done
+
+The report can be printed at any time with monitor.report(), or from outside
+the process with a signal: kill -USR1 <pid> (see install_signal_handler()).
+"""
+import math
+import signal
+import threading
+import time
+
+import numpy as np
+
+STAGES = ['capture', 'vad', 'buffer', 'queue', 'embedding', 'classification', 'total']
+
+
+class LatencyHistogram:
+    """Histogram of durations in seconds, with log-spaced bins between min_latency and max_latency."""
+    def __init__(self, min_latency=1e-6, max_latency=100.0, bins_per_decade=50):
+        self.min_latency = min_latency
+        self.bins_per_decade = bins_per_decade
+        self.log_min = math.log10(min_latency)
+        n_bins = int(math.ceil((math.log10(max_latency) - self.log_min) * bins_per_decade)) + 1
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.n = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds <= self.min_latency:
+            i = 0
+        else:
+            i = min(int((math.log10(seconds) - self.log_min) * self.bins_per_decade), len(self.counts) - 1)
+        self.counts[i] += 1
+        self.n += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper edge of the bin containing the q-th percentile (0 <= q <= 100)."""
+        counts = self.counts.copy()
+        total = counts.sum()
+        if total == 0:
+            return float('nan')
+        i = int(np.searchsorted(np.cumsum(counts), q / 100 * total))
+        return 10 ** (self.log_min + (i + 1) / self.bins_per_decade)
+
+    def reset(self):
+        self.counts[:] = 0
+        self.n = 0
+        self.max = 0.0
+
+
+class PipelineMonitor:
+    def __init__(self, stages=STAGES):
+        self.histograms = { stage: LatencyHistogram() for stage in stages }
+        self.xruns = 0
+        self.dropped = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.queue_depths = np.zeros(64, dtype=np.int64)
+        self.start_time = time.perf_counter()
+        # Chunks are dropped and queue depths recorded by both the audio callback and the inference loop.
+        self.lock = threading.Lock()
+
+    def record(self, stage, start, end):
+        self.histograms[stage].record(end - start)
+
+    def xrun(self):
+        # Audio callback only.
+        self.xruns += 1
+
+    def drop(self):
+        with self.lock:
+            self.dropped += 1
+
+    def record_queue_depth(self, depth):
+        with self.lock:
+            self.queue_depth = depth
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+            self.queue_depths[min(depth, len(self.queue_depths) - 1)] += 1
+
+    def report(self):
+        lines = ["{:15s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}".format("stage", "n", "p50 (ms)", "p95 (ms)", "p99 (ms)", "max (ms)")]
+        for stage, histogram in self.histograms.items():
+            if histogram.n == 0:
+                continue
+            lines.append("{:15s} {:8d} {:10.2f} {:10.2f} {:10.2f} {:10.2f}".format(
+                stage, histogram.n, 1000 * histogram.percentile(50), 1000 * histogram.percentile(95),
+                1000 * histogram.percentile(99), 1000 * histogram.max))
+        depths = self.queue_depths.copy()
+        mean_depth = (depths * np.arange(len(depths))).sum() / max(depths.sum(), 1)
+        lines.append("xruns: {} dropped: {} queue depth: {} (mean {:.2f}, max {}) uptime: {:.0f} s".format(
+            self.xruns, self.dropped, self.queue_depth, mean_depth, self.max_queue_depth, time.perf_counter() - self.start_time))
+        return "\n".join(lines)
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.xruns = 0
+        with self.lock:
+            self.dropped = 0
+            self.max_queue_depth = 0
+            self.queue_depths[:] = 0
+
+    def install_signal_handler(self, signum=getattr(signal, 'SIGUSR1', None)):
+        """Prints the report when the process receives signum (SIGUSR1 by default, not available on Windows)."""
+        if signum is None:
+            return
+        signal.signal(signum, lambda signum, frame: print(self.report(), flush=True))
+
+
+def capture_time(time_info):
+    """Estimates when the current audio block was captured by the ADC, on the time.perf_counter() clock.
+
+    Returns (capture_time, callback_time) from the time_info of a sounddevice callback.
+    """
+    now = time.perf_counter()
+    try:
+        delay = time_info.currentTime - time_info.inputBufferAdcTime
+    except AttributeError:
+        delay = 0
+    # Some host APIs do not report the ADC time.
+    if not 0 <= delay < 1:
+        delay = 0
+    return now - delay, now
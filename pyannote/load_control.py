@@ -0,0 +1,143 @@
+"""Adaptive load shedding for the realtime pipeline.
+
+LoadController watches the recent capture-to-classification latency, queue
+depth and dropped chunks of a SpeakerStream, and the tick overruns of the agent
+when it runs in the same process (main/orchestrator.py). When the latency
+budget is exceeded, the inference queue backs up, chunks are dropped (too late
+to publish, or pushed out of a full queue) or ticks slip, it steps up one load
+level.
+Each level embeds less often (longer hop between chunks), embeds queued
+chunks in larger batches, lowers the agent's steps per second and prints less.
+After calm_intervals quiet intervals, it steps back down one level.
+
+Level changes are sent over OSC as a bundle (/load/level, /load/hop,
+/load/batch-size, /load/fps, /load/verbosity, /load/latency, /load/queue-depth,
+/load/dropped, /load/overruns), by default to the agent's telemetry port (8000).
+"""
+import time
+
+import numpy as np
+from pythonosc import osc_bundle_builder, osc_message_builder, udp_client
+
+# hop: in units of the base hop, fps: fraction of the nominal agent steps per second.
+LEVELS = [
+    { 'hop': 1.0, 'batch_size': 1, 'fps': 1.0, 'verbosity': 2 },
+    { 'hop': 1.0, 'batch_size': 2, 'fps': 1.0, 'verbosity': 1 },
+    { 'hop': 1.5, 'batch_size': 4, 'fps': 0.6, 'verbosity': 1 },
+    { 'hop': 2.0, 'batch_size': 4, 'fps': 0.4, 'verbosity': 0 },
+]
+
+TELEMETRY_IP = "127.0.0.1"
+TELEMETRY_PORT = 8000
+
+
+class LoadController:
+    def __init__(self, stream, agent=None, latency_budget=0.5, interval=1.0, max_queue_depth=2,
+                 max_overrun_fraction=0.2, calm_intervals=5, osc_ip=TELEMETRY_IP, osc_port=TELEMETRY_PORT,
+                 levels=LEVELS):
+        self.stream = stream
+        self.agent = agent
+        self.latency_budget = latency_budget
+        self.interval = interval
+        self.max_queue_depth = max_queue_depth
+        self.max_overrun_fraction = max_overrun_fraction
+        self.calm_intervals = calm_intervals
+        self.levels = levels
+        self.client = udp_client.SimpleUDPClient(osc_ip, osc_port) if osc_ip is not None else None
+
+        self.base_hop = stream.hop_samples / stream.sample_rate
+        self.base_fps = agent.stepsPerSecond if agent is not None else None
+        self.level = 0
+        self.calm = 0
+        self.last_update = time.perf_counter()
+        self.last_published = stream.n_published
+        self.last_dropped = stream.monitor.dropped
+        self.dropped = 0
+        self.max_depth = 0
+        self.ticks = 0
+        self.overruns = 0
+        self.latency = 0.0
+        self.overrun_fraction = 0.0
+
+    def record_tick(self, lateness, period):
+        """Called for each agent tick with how late it started (seconds). Ticks late by half a period are overruns."""
+        self.ticks += 1
+        if lateness > 0.5 * period:
+            self.overruns += 1
+
+    def measure(self):
+        # Latency of the chunks published since the last update (p95), chunks dropped since then, deepest queue
+        # seen, fraction of late ticks. Under overload most chunks are dropped and never published: their
+        # latency is missing, so drops count as overload on their own.
+        n_new = min(self.stream.n_published - self.last_published, len(self.stream.latencies))
+        self.last_published = self.stream.n_published
+        dropped = self.stream.monitor.dropped
+        self.dropped = dropped - self.last_dropped
+        self.last_dropped = dropped
+        latencies = list(self.stream.latencies)[-n_new:] if n_new > 0 else []
+        self.latency = float(np.percentile(latencies, 95)) if latencies else 0.0
+        depth = max(self.max_depth, self.stream.queue_depth())
+        self.overrun_fraction = self.overruns / self.ticks if self.ticks else 0.0
+        self.max_depth = 0
+        self.ticks = 0
+        self.overruns = 0
+        return depth
+
+    def update(self, now=None):
+        """Measures the load and changes level if needed, at most once per interval. Cheap to call often."""
+        if now is None:
+            now = time.perf_counter()
+        self.max_depth = max(self.max_depth, self.stream.queue_depth())
+        if now - self.last_update < self.interval:
+            return
+        self.last_update = now
+        depth = self.measure()
+        overloaded = (self.latency > self.latency_budget or depth >= self.max_queue_depth or self.dropped > 0
+                      or self.overrun_fraction > self.max_overrun_fraction)
+        calm = (self.latency < 0.5 * self.latency_budget and depth <= 1 and self.dropped == 0
+                and self.overrun_fraction == 0)
+        if overloaded:
+            self.calm = 0
+            if self.level < len(self.levels) - 1:
+                self.set_level(self.level + 1, depth)
+        elif calm:
+            self.calm += 1
+            if self.calm >= self.calm_intervals and self.level > 0:
+                self.calm = 0
+                self.set_level(self.level - 1, depth)
+        else:
+            self.calm = 0
+
+    def set_level(self, level, depth=0):
+        self.level = level
+        settings = self.levels[level]
+        self.stream.set_hop(self.base_hop * settings['hop'])
+        self.stream.batch_size = settings['batch_size']
+        self.stream.verbosity = settings['verbosity']
+        fps = None
+        if self.agent is not None:
+            fps = max(1.0, self.base_fps * settings['fps'])
+            self.agent.stepsPerSecond = fps
+            self.agent.verbose = settings['verbosity'] > 0
+        print("Load level {}: hop {:.2f} s, batch size {}, agent fps {}, verbosity {} "
+              "(p95 latency {:.0f} ms, queue depth {}, {} dropped, late ticks {:.0f} %)".format(
+              level, self.stream.hop_samples / self.stream.sample_rate, settings['batch_size'],
+              "-" if fps is None else "{:.1f}".format(fps), settings['verbosity'],
+              1000 * self.latency, depth, self.dropped, 100 * self.overrun_fraction))
+        self.send(settings, fps, depth)
+
+    def send(self, settings, fps, depth):
+        if self.client is None:
+            return
+        messages = { "/load/level": self.level, "/load/hop": self.stream.hop_samples / self.stream.sample_rate,
+                     "/load/batch-size": settings['batch_size'], "/load/verbosity": settings['verbosity'],
+                     "/load/latency": self.latency, "/load/queue-depth": depth, "/load/dropped": self.dropped,
+                     "/load/overruns": self.overrun_fraction }
+        if fps is not None:
+            messages["/load/fps"] = fps
+        bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+        for path, value in messages.items():
+            msg_builder = osc_message_builder.OscMessageBuilder(address=path)
+            msg_builder.add_arg(float(value) if isinstance(value, float) else int(value))
+            bundle.add_content(msg_builder.build())
+        self.client.send(bundle.build())
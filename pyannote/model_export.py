@@ -0,0 +1,217 @@
+"""Export of the embedding model and trustnet for CPU inference.
+
+Exports the pyannote embedding model and the trustnet classifier to TorchScript
+and/or ONNX (ONNX Runtime), optionally with dynamic int8 quantization. After
+exporting, checks accuracy parity against eager mode on held-out audio and
+benchmarks latency and throughput.
+
+    python model_export.py --formats torchscript onnx --quantize
+
+Exported models can be loaded with load_exported(), which returns a function
+taking and returning float32 numpy arrays.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+import trustnet_artifact
+
+HUGGING_FACE_AUTH_TOKEN=""
+
+sample_rate = 16000
+chunk_duration = 1.0
+
+# Minimum acceptable parity between eager and exported models.
+min_embedding_cosine = 0.99
+min_class_agreement = 0.95
+
+
+def load_embedding_model():
+    from pyannote.audio import Model
+    model = Model.from_pretrained("pyannote/embedding", use_auth_token=HUGGING_FACE_AUTH_TOKEN)
+    return model.eval()
+
+
+def load_trustnet(filename):
+    # The exported embedding model is pyannote/embedding: trustnet must have been trained on its embeddings.
+    model, metadata = trustnet_artifact.load_trustnet(filename, backend="pyannote")
+    return model
+
+
+def quantize(model):
+    """Dynamic int8 quantization of the linear and recurrent layers."""
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+
+
+def export_torchscript(model, example, filename, quantized=False):
+    if quantized:
+        model = quantize(model)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+    torch.jit.save(traced, filename)
+    return filename
+
+
+def export_onnx(model, example, filename, quantized=False, dynamic_time=False):
+    dynamic_axes = { 'input': { 0: 'batch' }, 'output': { 0: 'batch' } }
+    if dynamic_time:
+        dynamic_axes['input'][2] = 'time'
+    # Quantization is done by ONNX Runtime on the exported fp32 graph.
+    fp32_filename = filename + ".fp32" if quantized else filename
+    with torch.no_grad():
+        torch.onnx.export(model, example, fp32_filename, input_names=['input'], output_names=['output'],
+                          dynamic_axes=dynamic_axes, opset_version=17)
+    if quantized:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(fp32_filename, filename, weight_type=QuantType.QInt8)
+        os.remove(fp32_filename)
+    return filename
+
+
+def load_exported(filename, n_threads=None):
+    """Loads an exported model. Returns a function mapping a float32 numpy array to a float32 numpy array."""
+    if filename.endswith(".onnx"):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if n_threads is not None:
+            options.intra_op_num_threads = n_threads
+        session = ort.InferenceSession(filename, options, providers=["CPUExecutionProvider"])
+        return lambda x: session.run(None, { 'input': np.ascontiguousarray(x, dtype=np.float32) })[0]
+    else:
+        if n_threads is not None:
+            torch.set_num_threads(n_threads)
+        module = torch.jit.load(filename, map_location="cpu")
+        def run(x):
+            with torch.inference_mode():
+                return module(torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))).numpy()
+        return run
+
+
+def eager(model):
+    def run(x):
+        with torch.inference_mode():
+            return model(torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))).numpy()
+    return run
+
+
+def load_held_out_chunks(pattern, max_chunks):
+    import librosa
+    chunk_samples = int(sample_rate * chunk_duration)
+    chunks = []
+    for f in sorted(glob.glob(pattern)):
+        audio, sr = librosa.load(f, sr=sample_rate)
+        for i in range(0, len(audio) - chunk_samples + 1, chunk_samples):
+            chunks.append(audio[i:i + chunk_samples])
+        if len(chunks) >= max_chunks:
+            break
+    if not chunks:
+        raise FileNotFoundError("No held-out audio found matching {}".format(pattern))
+    return np.stack(chunks[:max_chunks]).astype(np.float32)[:, np.newaxis]
+
+
+def cosine_similarities(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return (a * b).sum(axis=1)
+
+
+def benchmark(run, batch, n_runs):
+    # Latency on single items and throughput on the full batch.
+    run(batch[:1])
+    latencies = []
+    for i in range(n_runs):
+        startTime = time.perf_counter()
+        run(batch[i % len(batch):i % len(batch) + 1])
+        latencies.append(time.perf_counter() - startTime)
+    startTime = time.perf_counter()
+    run(batch)
+    throughput = len(batch) / (time.perf_counter() - startTime)
+    return np.percentile(latencies, 50) * 1000, np.percentile(latencies, 95) * 1000, throughput
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--trustnet", type=str, help="Trained trustnet model", default="trustnet.pt")
+    parser.add_argument("--out-dir", type=str, help="Output directory", default="exported")
+    parser.add_argument("--formats", nargs="+", choices=["torchscript", "onnx"], default=["torchscript", "onnx"])
+    parser.add_argument("--quantize", default=False, action=argparse.BooleanOptionalAction, help="Also export int8 versions")
+    parser.add_argument("--held-out", type=str, help="Held-out audio files", default="./Voices/split/*.wav")
+    parser.add_argument("--max-chunks", type=int, help="Number of held-out chunks", default=64)
+    parser.add_argument("--n-runs", type=int, help="Number of runs for latency", default=50)
+    parser.add_argument("--threads", type=int, help="Number of CPU threads", default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    embedding_model = load_embedding_model()
+    trustnet = load_trustnet(args.trustnet)
+
+    chunks = load_held_out_chunks(args.held_out, args.max_chunks)
+    reference_embeddings = eager(embedding_model)(chunks)
+    reference_outputs = eager(trustnet)(reference_embeddings)
+    classification = reference_outputs.shape[1] > 1
+
+    # Export.
+    exported = []
+    for fmt in args.formats:
+        for quantized in ([False, True] if args.quantize else [False]):
+            suffix = ".int8" if quantized else ""
+            for name, model, example, dynamic_time in [
+                    ("embedding", embedding_model, torch.from_numpy(chunks[:1]), True),
+                    ("trustnet", trustnet, torch.from_numpy(reference_embeddings[:1]), False)]:
+                try:
+                    if fmt == "torchscript":
+                        filename = export_torchscript(model, example, os.path.join(args.out_dir, name + suffix + ".pt"), quantized)
+                    else:
+                        filename = export_onnx(model, example, os.path.join(args.out_dir, name + suffix + ".onnx"), quantized, dynamic_time)
+                except Exception as e:
+                    print("Could not export {}{} to {}: {}".format(name, suffix, fmt, e))
+                    continue
+                print("Exported {}".format(filename))
+                exported.append((name, filename))
+
+    # Accuracy parity.
+    print()
+    print("Parity on {} held-out chunks".format(len(chunks)))
+    failed = False
+    for name, filename in exported:
+        run = load_exported(filename, args.threads)
+        if name == "embedding":
+            similarities = cosine_similarities(reference_embeddings, run(chunks))
+            ok = similarities.min() >= min_embedding_cosine
+            print("  {:40s} cosine min = {:.5f} mean = {:.5f} {}".format(
+                filename, similarities.min(), similarities.mean(), "OK" if ok else "FAILED"))
+        else:
+            outputs = run(reference_embeddings)
+            if classification:
+                agreement = (outputs.argmax(axis=1) == reference_outputs.argmax(axis=1)).mean()
+            else:
+                agreement = (np.round(outputs) == np.round(reference_outputs)).mean()
+            ok = agreement >= min_class_agreement
+            print("  {:40s} max abs diff = {:.5f} agreement = {:.1f} % {}".format(
+                filename, np.abs(outputs - reference_outputs).max(), 100 * agreement, "OK" if ok else "FAILED"))
+        failed = failed or not ok
+
+    # Benchmark.
+    print()
+    print("{:40s} {:>10s} {:>10s} {:>14s}".format("Model", "p50 (ms)", "p95 (ms)", "items/s"))
+    rows = [("embedding", "eager", eager(embedding_model)), ("trustnet", "eager", eager(trustnet))]
+    rows += [(name, filename, load_exported(filename, args.threads)) for name, filename in exported]
+    for name, label, run in rows:
+        batch = chunks if name == "embedding" else reference_embeddings
+        p50, p95, throughput = benchmark(run, batch, args.n_runs)
+        print("{:40s} {:10.3f} {:10.3f} {:14.1f}".format(name + " " + label if label == "eager" else label, p50, p95, throughput))
+
+    if failed:
+        print()
+        print("Some exported models do not match eager mode: do not use them in production.")
+        sys.exit(1)
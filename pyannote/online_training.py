@@ -0,0 +1,158 @@
+"""Online fine-tuning of trustnet from live embeddings.
+
+Embeddings that the live model classifies with high confidence are kept, with
+the predicted class as label, in a bounded replay store. A background thread
+periodically takes a few small gradient steps on a private copy of the model,
+drawing class-balanced mini-batches from the store, and then swaps a copy of
+the updated weights into the live pipeline. Inference never waits for
+training: the swap is a single reference assignment.
+
+    stream = SpeakerStream("trustnet.pt")
+    trainer = OnlineTrainer(stream.model, n_classes=len(stream.speaker_pleasure), on_update=stream.set_model)
+    trainer.start()
+"""
+import copy
+import threading
+
+import numpy as np
+import torch
+from torch import nn
+
+from trustnet import compute_loss
+
+
+class ReplayStore:
+    """Bounded ring buffer of (embedding, label) pairs. The oldest pairs are overwritten first."""
+    def __init__(self, dim, capacity=2048):
+        self.embeddings = np.zeros((capacity, dim), dtype=np.float32)
+        self.labels = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.n = 0
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.n
+
+    def add(self, embedding, label):
+        with self.lock:
+            self.embeddings[self.position] = embedding
+            self.labels[self.position] = label
+            self.position = (self.position + 1) % self.capacity
+            self.n = min(self.n + 1, self.capacity)
+
+    def sample(self, batch_size, rng, balanced=True):
+        """Random mini-batch of (embeddings, labels). With balanced, every label is drawn equally often."""
+        with self.lock:
+            labels = self.labels[:self.n]
+            if balanced:
+                values, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+                p = 1.0 / counts[inverse]
+                p /= p.sum()
+            else:
+                p = None
+            indices = rng.choice(self.n, size=min(batch_size, self.n), replace=False, p=p)
+            return self.embeddings[indices].copy(), labels[indices].copy()
+
+
+class OnlineTrainer:
+    def __init__(self, model, regression_model=False, on_update=None, min_confidence=0.9, capacity=2048,
+                 min_samples=64, batch_size=32, steps_per_update=10, lr=0.01, interval=5.0, seed=0, n_classes=None):
+        self.regression_model = regression_model
+        # Number of speakers: regression outputs that round outside [0, n_classes - 1] are not speakers.
+        if n_classes is None and regression_model:
+            raise ValueError("Online training of a regression model requires n_classes")
+        self.n_classes = n_classes
+        self.on_update = on_update
+        self.min_confidence = min_confidence
+        self.min_samples = min_samples
+        self.batch_size = batch_size
+        self.steps_per_update = steps_per_update
+        self.interval = interval
+        self.rng = np.random.default_rng(seed)
+
+        # Training runs on a private copy of the model, on CPU, so that it never touches the live model.
+        self.device = next(model.parameters()).device
+        self.training_model = copy.deepcopy(model).cpu()
+        self.criterion = nn.MSELoss() if regression_model else nn.CrossEntropyLoss()
+        self.optimizer = torch.optim.SGD(self.training_model.parameters(), lr=lr)
+        self.store = ReplayStore(model[0].in_features, capacity)
+
+        self.n_observed = 0
+        self.n_updates = 0
+        self.last_loss = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def confident_label(self, output):
+        """Label predicted from the raw model output, or None if the prediction is not confident enough."""
+        output = np.asarray(output, dtype=np.float32)
+        if self.regression_model:
+            # Regression output is a (fractional) speaker index: confident when close to an integer.
+            index = float(output[0])
+            confidence = 1 - 2 * abs(index - round(index))
+            label = float(round(index))
+            # Training toward an index that is no speaker would reinforce the error.
+            if not 0 <= label <= self.n_classes - 1:
+                return None
+        else:
+            probabilities = output / max(output.sum(), 1e-6)
+            label = int(probabilities.argmax())
+            confidence = float(probabilities[label])
+        return label if confidence >= self.min_confidence else None
+
+    def observe(self, embedding, output):
+        """Keeps embedding for training if the live model classified it confidently. Returns True if kept."""
+        label = self.confident_label(output)
+        if label is None:
+            return False
+        self.store.add(embedding, label)
+        self.n_observed += 1
+        return True
+
+    def update(self):
+        """Takes steps_per_update training steps and publishes the updated model. Returns the mean loss."""
+        if len(self.store) < self.min_samples:
+            return None
+        self.training_model.train()
+        losses = []
+        for i in range(self.steps_per_update):
+            embeddings, labels = self.store.sample(self.batch_size, self.rng, balanced=not self.regression_model)
+            inputs = torch.from_numpy(embeddings)
+            labels = torch.from_numpy(labels) if self.regression_model else torch.from_numpy(labels).long()
+            self.optimizer.zero_grad(set_to_none=True)
+            loss = compute_loss(self.criterion, self.training_model(inputs), labels)
+            loss.backward()
+            self.optimizer.step()
+            losses.append(loss.item())
+        self.training_model.eval()
+
+        # Publish a copy: the live pipeline keeps using the previous model until the reference is replaced.
+        model = copy.deepcopy(self.training_model).to(self.device)
+        model.eval()
+        if self.on_update is not None:
+            self.on_update(model)
+        self.n_updates += 1
+        self.last_loss = float(np.mean(losses))
+        return self.last_loss
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.update()
+
+    def start(self):
+        """Runs update() every interval seconds in a background thread."""
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="online-training", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def report(self):
+        return "online training: {} confident embeddings kept ({} in store), {} updates, last loss {}".format(
+            self.n_observed, len(self.store), self.n_updates,
+            "n/a" if self.last_loss is None else "{:.5f}".format(self.last_loss))
@@ -0,0 +1,125 @@
+"""On-disk cache of decoded and resampled audio.
+
+Source recordings (any format and sample rate readable by soundfile) are
+decoded, mixed down to mono and resampled once, then stored as raw 16-bit PCM
+at the target sample rate. Later runs memory-map the PCM file instead of
+decoding and resampling again. An entry is rebuilt whenever the size or the
+modification time of its source changes.
+
+    cache = PCMCache("pcm_cache", sample_rate=16000)
+    pcm = cache.load("voice.wav")          # int16 memmap
+    audio = cache.load_float("voice.wav")  # float32 in [-1, 1]
+
+prefetch() runs a function over many files in a thread pool, a bounded number
+of files ahead of the consumer: decoding (libsndfile) and resampling (soxr)
+release the GIL, so conversion overlaps with the VAD and the embedding model.
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_PCM_CACHE_DIR = "pcm_cache"
+PCM_SCALE = 32767
+
+
+def to_pcm(audio):
+    """float audio in [-1, 1] -> int16 PCM, scaled like the VAD input."""
+    return (np.clip(audio, -1, 1) * PCM_SCALE).astype(np.int16)
+
+
+def to_float(pcm):
+    return pcm.astype(np.float32) * np.float32(1 / PCM_SCALE)
+
+
+class PCMCache:
+    def __init__(self, cache_dir=DEFAULT_PCM_CACHE_DIR, sample_rate=16000, block_duration=10.0):
+        self.cache_dir = cache_dir
+        self.sample_rate = sample_rate
+        self.block_duration = block_duration
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, source):
+        """Path of the PCM file of source (its metadata is stored next to it, as .json)."""
+        name = hashlib.sha256(os.path.abspath(source).encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.cache_dir, "{}-{}.s16".format(name, self.sample_rate))
+
+    def metadata(self, source):
+        stat = os.stat(source)
+        return { 'source': os.path.abspath(source), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                 'sample_rate': self.sample_rate }
+
+    def is_valid(self, source):
+        path = self.path(source)
+        try:
+            with open(path + ".json") as f:
+                cached = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        n_samples = cached.pop('n_samples', None)
+        return (cached == self.metadata(source) and os.path.exists(path)
+                and os.path.getsize(path) == 2 * n_samples)
+
+    def convert(self, source):
+        """Decodes, mixes down and resamples source block by block into its PCM file."""
+        import soundfile as sf
+        import soxr
+        path = self.path(source)
+        metadata = self.metadata(source)
+        # Several threads or processes may convert the same file: each writes its own temporary file.
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        n_samples = 0
+        with sf.SoundFile(source) as f, open(tmp_path, "wb") as out:
+            resampler = soxr.ResampleStream(f.samplerate, self.sample_rate, 1, dtype='float32') if f.samplerate != self.sample_rate else None
+            block_frames = int(f.samplerate * self.block_duration)
+            last = False
+            while not last:
+                block = f.read(block_frames, dtype='float32', always_2d=True)
+                last = len(block) < block_frames
+                audio = block.mean(axis=1)
+                if resampler is not None:
+                    audio = resampler.resample_chunk(audio, last=last)
+                pcm = to_pcm(audio)
+                out.write(pcm.tobytes())
+                n_samples += len(pcm)
+        os.replace(tmp_path, path)
+        # The metadata is written last: an interrupted conversion is redone on the next run.
+        with open(tmp_path, "w") as f:
+            json.dump(dict(metadata, n_samples=n_samples), f)
+        os.replace(tmp_path, path + ".json")
+
+    def warm(self, source):
+        """Converts source if its PCM file is missing or stale. Returns the path of the PCM file."""
+        if not self.is_valid(source):
+            self.convert(source)
+        return self.path(source)
+
+    def load(self, source):
+        """16-bit PCM of source at the sample rate of the cache, memory-mapped. Converts source if needed."""
+        if not self.is_valid(source):
+            self.convert(source)
+        path = self.path(source)
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=np.int16)
+        return np.memmap(path, dtype=np.int16, mode="r")
+
+    def load_float(self, source):
+        """Audio of source as float32 in [-1, 1]."""
+        return to_float(self.load(source))
+
+
+def prefetch(function, items, n_threads=4, depth=None):
+    """Yields function(item) for each item, in order, computing up to depth results ahead in n_threads threads."""
+    depth = depth or 2 * n_threads
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = collections.deque()
+        for item in items:
+            futures.append(executor.submit(function, item))
+            if len(futures) >= depth:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
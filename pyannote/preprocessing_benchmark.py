@@ -0,0 +1,64 @@
+"""Throughput of the training preprocessing (decoding, VAD and chunking), in audio seconds per second.
+
+Compares the former frame-by-frame VAD loop with the vectorized framing, and sequential with parallel
+per-file preprocessing.
+
+    python preprocessing_benchmark.py "./Voices/VOIX TELEO *.wav"
+"""
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import librosa
+import webrtcvad
+
+from speaker_dataset import SpeakerEmbeddingDataset, voiced_audio, frame_duration
+
+
+def voiced_audio_loop(audio, vad, sample_rate):
+    # Former implementation: one int16 conversion and one tobytes() per frame.
+    frame_samples = int(sample_rate * frame_duration)
+    voiced_frames = []
+    for i in range(0, len(audio) - frame_samples + 1, frame_samples):
+        frame = audio[i:i+frame_samples]
+        if vad.is_speech((frame * 32767).astype(np.int16).tobytes(), sample_rate):
+            voiced_frames.append(frame)
+    return np.concatenate(voiced_frames) if voiced_frames else audio[:0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("files", type=str, help="Audio files (glob pattern)", nargs="?", default="./Voices/VOIX TELEO *.wav")
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--vad-mode", type=int, default=3)
+    parser.add_argument("--workers", type=int, help="Number of worker processes", default=os.cpu_count())
+    args = parser.parse_args()
+
+    file_paths = sorted(glob.glob(args.files))
+    if not file_paths:
+        raise FileNotFoundError("No audio files matching {}".format(args.files))
+
+    # VAD only, on decoded audio.
+    audios = [librosa.load(f, sr=args.sample_rate)[0] for f in file_paths]
+    audio_seconds = sum(len(a) for a in audios) / args.sample_rate
+    print("{} files, {:.1f} s of audio".format(len(file_paths), audio_seconds))
+    for name, function in [("VAD frame loop", voiced_audio_loop), ("VAD vectorized", voiced_audio)]:
+        vad = webrtcvad.Vad(args.vad_mode)
+        startTime = time.perf_counter()
+        voiced = [function(a, vad, args.sample_rate) for a in audios]
+        elapsed = time.perf_counter() - startTime
+        print("{:30s} {:10.1f} audio s/s ({:.1f} s voiced)".format(
+            name, audio_seconds / elapsed, sum(len(v) for v in voiced) / args.sample_rate))
+
+    # Decoding, VAD and chunking of every file (no embedding).
+    class NoEmbeddingDataset(SpeakerEmbeddingDataset):
+        def embed_chunks(self, chunks):
+            return np.zeros((len(chunks), 1), dtype=np.float32)
+
+    for n_workers in [0, args.workers]:
+        startTime = time.perf_counter()
+        NoEmbeddingDataset(file_paths, sample_rate=args.sample_rate, vad_mode=args.vad_mode, cache_dir=None, n_workers=n_workers)
+        elapsed = time.perf_counter() - startTime
+        print("{:30s} {:10.1f} audio s/s".format("Decode + VAD, {} workers".format(n_workers), audio_seconds / elapsed))
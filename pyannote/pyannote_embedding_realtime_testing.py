@@ -2,12 +2,11 @@ import sounddevice as sd
 import numpy as np
 import torch  # Import torch
 from scipy.signal import resample
-from pyannote.audio import Model, Inference
 from queue import Queue
 import time
 import webrtcvad
-
-HUGGING_FACE_AUTH_TOKEN=""
+from embedding_service import load_embedder
+from latency import PipelineMonitor, capture_time
 
 # Parameters
 sample_rate = 16000  # Audio sample rate
@@ -21,35 +20,50 @@ vad = webrtcvad.Vad()
 # Set aggressiveness from 0 to 3 (3 is the most aggressive)
 vad.set_mode(3)
 
-# Instantiate pretrained model
-model = Model.from_pretrained("pyannote/embedding", use_auth_token=HUGGING_FACE_AUTH_TOKEN)
-inference = Inference(model, window="whole")
+# Embedding model (through the embedding service if it is running)
+embed, embed_file = load_embedder(sample_rate=sample_rate)
 
 # Queue to hold audio data
 audio_queue = Queue()
 
 # Buffer for accumulating audio data
 audio_buffer = np.array([])
+buffer_start_time = None
+
+# Per-stage latencies (print at any time with kill -USR1 <pid>)
+monitor = PipelineMonitor()
+monitor.install_signal_handler()
 
-def audio_callback(indata, frames, time, status):
+def audio_callback(indata, frames, time_info, status):
     """This is called for each audio chunk from the microphone."""
-    global audio_buffer
+    global audio_buffer, buffer_start_time
+    frame_time, callback_time = capture_time(time_info)
+    monitor.record('capture', frame_time, callback_time)
     if status:
+        if status.input_overflow or status.input_underflow:
+            monitor.xrun()
         print(status)
 
     if frames == frame_samples:  # Ensure frame size is as expected
         audio_frame = (indata[:, 0] * 32767).astype(np.int16).tobytes()
         is_speech = vad.is_speech(audio_frame, sample_rate)
+        monitor.record('vad', frame_time, time.perf_counter())
         if is_speech:
+            if len(audio_buffer) == 0:
+                buffer_start_time = frame_time
             # Accumulate audio data in the buffer
             audio_buffer = np.append(audio_buffer, indata[:, 0])
 
             # When buffer reaches 5 seconds of audio, process it
             if len(audio_buffer) >= sample_rate * duration:
+                complete_time = time.perf_counter()
+                monitor.record('buffer', buffer_start_time, complete_time)
                 # Optionally resample here if needed
-                audio_queue.put(audio_buffer[:sample_rate * duration])
+                audio_queue.put((audio_buffer[:sample_rate * duration], frame_time, complete_time))
+                monitor.record_queue_depth(audio_queue.qsize())
                 # Remove processed data from buffer
                 audio_buffer = audio_buffer[sample_rate * duration:]
+                buffer_start_time = frame_time
                 print("Append to audio queue")
 
 # Start recording from the microphone
@@ -59,13 +73,17 @@ with sd.InputStream(samplerate=sample_rate, channels=channels, callback=audio_ca
         while True:
             # Check if there is new data in the queue
             if not audio_queue.empty():
-                data = audio_queue.get()
-                # Convert numpy array to PyTorch tensor and add channel dimension
-                tensor_data = torch.tensor(data).unsqueeze(0).float()
-                # Ensure it has shape (channel, time)
-                embedding = inference({'waveform': tensor_data, 'sample_rate': sample_rate})
+                data, frame_time, complete_time = audio_queue.get()
+                dequeue_time = time.perf_counter()
+                monitor.record('queue', complete_time, dequeue_time)
+                monitor.record_queue_depth(audio_queue.qsize())
+                embedding = embed(data)
+                embedding_time = time.perf_counter()
+                monitor.record('embedding', dequeue_time, embedding_time)
+                monitor.record('total', frame_time, embedding_time)
                 print("Computed Embedding:", embedding.shape)
                 print(embedding)
             time.sleep(0.1)
     except KeyboardInterrupt:
         print("Stopped recording.")
+        print(monitor.report())
@@ -1,17 +1,11 @@
 import numpy as np
 import glob
 
-HUGGING_FACE_AUTH_TOKEN=""
-
 # 1. visit hf.co/pyannote/embedding and accept user conditions
-# 2. visit hf.co/settings/tokens to create an access token
-# 3. instantiate pretrained model
-from pyannote.audio import Model
-model = Model.from_pretrained("pyannote/embedding", 
-                              use_auth_token=HUGGING_FACE_AUTH_TOKEN)
-
-from pyannote.audio import Inference
-inference = Inference(model, window="whole")
+# 2. visit hf.co/settings/tokens to create an access token (see HUGGING_FACE_AUTH_TOKEN in embedding_backends.py)
+# 3. instantiate pretrained model (through the embedding service if it is running)
+from embedding_service import load_embedder
+embed, embed_file = load_embedder()
 
 # Create data.
 filepaths = sorted(glob.glob("./Voices/split/*.wav"))
@@ -19,23 +13,33 @@ filepaths = sorted(glob.glob("./Voices/split/*.wav"))
 embeddings = []
 
 for f in filepaths:
-  embeddings.append( inference(f) )
+  embeddings.append( embed_file(f) )
 
 embeddings = np.asarray(embeddings)
 print( embeddings.shape )
 
 # `embeddingX` is (1 x D) numpy array extracted from the file as a whole.
 
-from scipy.spatial.distance import cdist, cosine
+# Similarities are computed in float32 row blocks: the full matrix is only built for the heatmap of a few clips.
+from similarity import SimilarityEngine
+import os
+
+engine = SimilarityEngine(embeddings)
+names = [os.path.basename(f) for f in filepaths]
+indices, scores = engine.top_k(5)
+for i, name in enumerate(names):
+  print(name, [(names[j], round(float(s), 3)) for j, s in zip(indices[i], scores[i])])
 
-inv_dist = 1 - cdist(embeddings, embeddings, metric = 'cosine')
-print(inv_dist)
+for group in engine.duplicate_groups(0.95):
+  print("Duplicates:", [names[i] for i in group])
 
-import matplotlib.pyplot as plt
-import seaborn as sns
+max_heatmap = 200
+if len(engine) <= max_heatmap:
+  import matplotlib.pyplot as plt
+  import seaborn as sns
 
-sns.heatmap(inv_dist)
-plt.show()
+  sns.heatmap(np.concatenate([similarities for start, similarities in engine.blocks()]))
+  plt.show()
 
 #from scipy.spatial.distance import cdist
 #distance = cdist(embedding1, embedding2, metric="cosine")[0,0]
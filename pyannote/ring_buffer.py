@@ -0,0 +1,89 @@
+"""Single-producer single-consumer ring buffer in shared memory.
+
+Each slot holds a fixed-shape numpy array and a few float64 timestamps. Slots
+are written and read in place in a multiprocessing.shared_memory block, so
+handing an audio frame or chunk from one stage to the next is a memory copy:
+nothing is pickled or sent through a socket. The block can be attached by name
+from another process (create=False), e.g. to monitor the buffer.
+
+The producer only advances the write counter and the consumer only advances
+the read counter, so one producer and one consumer need no lock.
+"""
+import numpy as np
+from multiprocessing import shared_memory
+
+HEADER_SIZE = 64  # write and read counters (int64), padded
+
+
+class RingBuffer:
+    def __init__(self, capacity, shape=(), dtype=np.float32, n_timestamps=1, name=None, create=True):
+        self.capacity = capacity
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.n_timestamps = n_timestamps
+        timestamps_size = 8 * capacity * n_timestamps
+        data_size = self.dtype.itemsize * capacity * int(np.prod(self.shape, dtype=np.int64))
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=HEADER_SIZE + timestamps_size + data_size)
+        self.owner = create
+        self.counters = np.ndarray(2, dtype=np.int64, buffer=self.shm.buf)
+        self.timestamps = np.ndarray((capacity, n_timestamps), dtype=np.float64, buffer=self.shm.buf, offset=HEADER_SIZE)
+        self.data = np.ndarray((capacity,) + self.shape, dtype=self.dtype, buffer=self.shm.buf,
+                               offset=HEADER_SIZE + timestamps_size)
+        if create:
+            self.counters[:] = 0
+        # Writes rejected because the buffer was full (producer side).
+        self.overruns = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __len__(self):
+        """Number of items ready to be read."""
+        return int(self.counters[0] - self.counters[1])
+
+    def full(self):
+        return len(self) >= self.capacity
+
+    def write(self, item, *timestamps):
+        """Copies item (and its timestamps) into the next slot. Returns False, without blocking, if the buffer is full."""
+        written = self.counters[0]
+        if written - self.counters[1] >= self.capacity:
+            self.overruns += 1
+            return False
+        slot = written % self.capacity
+        self.data[slot] = item
+        self.timestamps[slot, :len(timestamps)] = timestamps
+        # Publish the slot only once it is complete.
+        self.counters[0] = written + 1
+        return True
+
+    def peek(self):
+        """(item, timestamps) of the oldest slot, as views valid until the next read(), or None if empty."""
+        if len(self) == 0:
+            return None
+        slot = self.counters[1] % self.capacity
+        return self.data[slot], self.timestamps[slot]
+
+    def read(self):
+        """Removes the oldest item. Returns (item, timestamps) as copies, or None if the buffer is empty."""
+        item = self.peek()
+        if item is None:
+            return None
+        item = (item[0].copy(), tuple(item[1]))
+        self.counters[1] += 1
+        return item
+
+    def drop(self):
+        """Discards the oldest item (consumer side). Returns False if the buffer is empty."""
+        if len(self) == 0:
+            return False
+        self.counters[1] += 1
+        return True
+
+    def close(self):
+        # Views on the shared memory must be released before it is closed.
+        del self.counters, self.timestamps, self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,123 @@
+"""In-process sampling profiler, started and stopped at runtime.
+
+While running, a background thread samples the Python stack of every other
+thread (sys._current_frames()) every interval seconds and counts identical
+stacks. On stop, the counts are written as folded stacks, one line per stack:
+
+    thread;outer function (file:line);...;inner function (file:line) count
+
+ready for flame graph tools (flamegraph.pl, speedscope, inferno). While stopped
+there is no sampling thread and no hook: the profiler costs nothing.
+
+The realtime processes start and stop their profiler on OSC messages
+/profile/start and /profile/stop (see serve_osc()):
+
+    oscsend localhost 8002 /profile/start
+    oscsend localhost 8002 /profile/stop
+"""
+import collections
+import os
+import sys
+import threading
+import time
+
+DEFAULT_PROFILE_DIR = "profiles"
+# OSC port of the speaker classifier's profiler (the agent uses its own port, 8001).
+PROFILE_PORT = 8002
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler:
+    def __init__(self, name, interval=0.005, output_dir=DEFAULT_PROFILE_DIR):
+        self.name = name
+        self.interval = interval
+        self.output_dir = output_dir
+        self.counts = collections.Counter()
+        self.n_samples = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def is_running(self):
+        return self.thread is not None
+
+    def start(self):
+        """Starts sampling (does nothing if already running)."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.counts.clear()
+            self.n_samples = 0
+            self.start_time = time.time()
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+            self.thread.start()
+        print("Profiler {} started".format(self.name))
+
+    def stop(self, background=False):
+        """Stops sampling and writes the folded stacks. Returns the file name, or None if not running.
+
+        With background, returns None at once: joining the sampler and writing the file happen in another
+        thread, off a realtime loop.
+        """
+        if background:
+            threading.Thread(target=self.stop, name="profile-writer", daemon=True).start()
+            return None
+        with self.lock:
+            if self.thread is None:
+                return None
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+            filename = self.write()
+        print("Profiler {}: {} samples written to {}".format(self.name, self.n_samples, filename))
+        return filename
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = { thread.ident: thread.name for thread in threading.enumerate() }
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.n_samples += 1
+
+    def write(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        filename = os.path.join(self.output_dir, "{}-{}-{}.folded".format(
+            self.name, os.getpid(), time.strftime("%Y%m%d-%H%M%S", time.localtime(self.start_time))))
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write("{} {}\n".format(stack, count))
+        os.replace(tmp_filename, filename)
+        return filename
+
+
+def serve_osc(profiler, port=PROFILE_PORT, ip="127.0.0.1"):
+    """Starts and stops profiler on /profile/start and /profile/stop received on ip:port, from a daemon thread.
+
+    Returns the server (to shut down), or None if the port cannot be bound: the process then runs without
+    profiling.
+    """
+    from pythonosc import dispatcher, osc_server
+    osc_dispatcher = dispatcher.Dispatcher()
+    osc_dispatcher.map("/profile/start", lambda address, *args: profiler.start())
+    osc_dispatcher.map("/profile/stop", lambda address, *args: profiler.stop())
+    try:
+        server = osc_server.ThreadingOSCUDPServer((ip, port), osc_dispatcher)
+    except OSError as e:
+        print("Profiler {} disabled: cannot listen on {}:{} ({})".format(profiler.name, ip, port, e))
+        return None
+    threading.Thread(target=server.serve_forever, name="profile-osc", daemon=True).start()
+    return server
@@ -0,0 +1,147 @@
+"""Blocked cosine similarity between large collections of embeddings.
+
+Similarities are computed in float32, one block of rows at a time, so the full
+N x N matrix is never held in memory. From the blocks, the engine can:
+  - write the full matrix to a memory-mapped file,
+  - return the top-k most similar clips of every clip,
+  - group (near) duplicate clips,
+  - flag clips whose nearest neighbors mostly carry another label (likely mislabeled).
+
+    python similarity.py "./Voices/split/*.wav" --top-k 5 --duplicate-threshold 0.95
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+
+import numpy as np
+
+from speaker_index import normalize
+
+
+class SimilarityEngine:
+    def __init__(self, embeddings, block_size=1024):
+        self.embeddings = normalize(embeddings)
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def blocks(self):
+        """Yields (start, similarities) where similarities is the (block size, N) block of rows starting at start."""
+        for start in range(0, len(self.embeddings), self.block_size):
+            yield start, self.embeddings[start:start + self.block_size] @ self.embeddings.T
+
+    def to_memmap(self, filename):
+        """Writes the N x N float32 similarity matrix to filename and returns it as a read-only memmap."""
+        n = len(self.embeddings)
+        matrix = np.lib.format.open_memmap(filename, mode="w+", dtype=np.float32, shape=(n, n))
+        for start, similarities in self.blocks():
+            matrix[start:start + len(similarities)] = similarities
+        matrix.flush()
+        del matrix
+        return np.load(filename, mmap_mode="r")
+
+    def top_k(self, k=5, exclude_self=True):
+        """Indices and similarities of the k most similar clips of every clip, as two (N, k) arrays."""
+        n = len(self.embeddings)
+        k = max(0, min(k, n - 1 if exclude_self else n))
+        indices = np.zeros((n, k), dtype=np.int64)
+        scores = np.zeros((n, k), dtype=np.float32)
+        if k == 0:
+            return indices, scores
+        for start, similarities in self.blocks():
+            rows = np.arange(len(similarities))
+            if exclude_self:
+                similarities[rows, start + rows] = -np.inf
+            best = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(similarities, best, axis=1)
+            order = np.argsort(-best_scores, axis=1)
+            indices[start:start + len(similarities)] = np.take_along_axis(best, order, axis=1)
+            scores[start:start + len(similarities)] = np.take_along_axis(best_scores, order, axis=1)
+        return indices, scores
+
+    def duplicate_groups(self, threshold=0.95):
+        """Groups of clips connected by a similarity of at least threshold (groups of one are omitted)."""
+        parent = np.arange(len(self.embeddings))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for start, similarities in self.blocks():
+            rows, columns = np.nonzero(similarities >= threshold)
+            rows += start
+            # Each pair once.
+            for i, j in zip(rows[columns > rows], columns[columns > rows]):
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+
+        groups = {}
+        for i in range(len(parent)):
+            groups.setdefault(find(i), []).append(i)
+        return [group for group in groups.values() if len(group) > 1]
+
+    def suspicious_labels(self, labels, k=5, min_agreement=0.5):
+        """Clips whose k nearest neighbors mostly have another label.
+
+        Returns a list of (index, label, majority label of the neighbors, fraction of neighbors with that label).
+        """
+        labels = np.asarray(labels)
+        indices, _ = self.top_k(k)
+        suspicious = []
+        if indices.shape[1] == 0:
+            return suspicious
+        for i, neighbors in enumerate(indices):
+            values, counts = np.unique(labels[neighbors], return_counts=True)
+            majority = values[np.argmax(counts)]
+            agreement = counts.max() / len(neighbors)
+            if majority != labels[i] and agreement > min_agreement:
+                suspicious.append((i, labels[i], majority, agreement))
+        return suspicious
+
+
+def label_of(path, pattern):
+    match = re.match(pattern, os.path.basename(path))
+    return match.group(1) if match else os.path.basename(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("files", type=str, help="Audio clips (glob pattern)", nargs="?", default="./Voices/split/*.wav")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--duplicate-threshold", type=float, default=0.95)
+    parser.add_argument("--label-pattern", type=str, help="Regex whose first group is the label of a clip (file name)", default=r"^([^_]+)")
+    parser.add_argument("--block-size", type=int, default=1024)
+    parser.add_argument("--memmap", type=str, help="Also write the full similarity matrix to this .npy file", default=None)
+    args = parser.parse_args()
+
+    filepaths = sorted(glob.glob(args.files))
+    if not filepaths:
+        sys.exit("No audio clips match {}".format(args.files))
+    from embedding_service import load_embedder
+    embed, embed_file = load_embedder()
+    engine = SimilarityEngine(np.stack([embed_file(f) for f in filepaths]), args.block_size)
+    names = [os.path.basename(f) for f in filepaths]
+
+    if args.memmap is not None:
+        engine.to_memmap(args.memmap)
+        print("Similarity matrix written to {}".format(args.memmap))
+
+    indices, scores = engine.top_k(args.top_k)
+    print("Top {} neighbors:".format(indices.shape[1]))
+    for i, name in enumerate(names):
+        print("  {}: {}".format(name, ", ".join("{} ({:.3f})".format(names[j], s) for j, s in zip(indices[i], scores[i]))))
+
+    print("Duplicate groups (similarity >= {}):".format(args.duplicate_threshold))
+    for group in engine.duplicate_groups(args.duplicate_threshold):
+        print("  " + ", ".join(names[i] for i in group))
+
+    print("Possibly mislabeled clips:")
+    labels = [label_of(f, args.label_pattern) for f in filepaths]
+    for i, label, majority, agreement in engine.suspicious_labels(labels, args.top_k):
+        print("  {}: labeled {}, {:.0f}% of its neighbors are {}".format(names[i], label, 100 * agreement, majority))
@@ -0,0 +1,363 @@
+import multiprocessing
+import os
+import queue
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import librosa
+import webrtcvad
+import torch
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+from embedding_backends import embedding_dim
+from embedding_cache import EmbeddingCache, DEFAULT_CACHE_DIR
+from embedding_service import load_embedder, embedding_revision
+from pcm_cache import PCMCache, DEFAULT_PCM_CACHE_DIR, to_float
+
+frame_duration = 0.02  # 20 ms VAD frames
+
+
+def voiced_audio(audio, vad, sample_rate):
+    """Keeps the 20 ms frames of audio that vad classifies as speech.
+
+    The signal is framed with a (copy-free) reshape and converted to 16-bit PCM in one go; the VAD then
+    runs over slices of a single buffer. audio can also be 16-bit PCM already (see pcm_cache.py); the
+    voiced audio is always returned as float32.
+    """
+    frame_samples = int(sample_rate * frame_duration)
+    n_frames = len(audio) // frame_samples
+    frames = audio[:n_frames * frame_samples].reshape(n_frames, frame_samples)
+    is_pcm = frames.dtype == np.int16
+    pcm = memoryview((frames if is_pcm else (frames * 32767).astype(np.int16)).tobytes())
+    frame_bytes = 2 * frame_samples
+    is_speech = vad.is_speech
+    mask = np.fromiter((is_speech(pcm[i:i + frame_bytes], sample_rate) for i in range(0, n_frames * frame_bytes, frame_bytes)),
+                       dtype=bool, count=n_frames)
+    voiced = frames[mask].reshape(-1)
+    return to_float(voiced) if is_pcm else voiced
+
+
+def extract_chunks(audio, sample_rate, chunk_duration):
+    """Splits audio into non-overlapping chunks, as an (N, chunk samples) view."""
+    chunk_samples = int(sample_rate * chunk_duration)
+    n_chunks = len(audio) // chunk_samples
+    return audio[:n_chunks * chunk_samples].reshape(n_chunks, chunk_samples)
+
+
+def load_voiced_chunks(file_path, sample_rate, chunk_duration, vad_mode, pcm_cache_dir=None):
+    """Decodes an audio file (or reads it from the PCM cache) and returns its voiced chunks. Runs in workers."""
+    if pcm_cache_dir is not None:
+        audio = PCMCache(pcm_cache_dir, sample_rate).load(file_path)
+    else:
+        audio, sr = librosa.load(file_path, sr=sample_rate)
+    return extract_chunks(voiced_audio(audio, webrtcvad.Vad(vad_mode), sample_rate), sample_rate, chunk_duration)
+
+
+def stream_voiced_chunks(file_path, sample_rate, chunk_duration, vad, block_duration=10.0):
+    """Yields the voiced chunks of an audio file, decoding, resampling and running the VAD block by block.
+
+    Memory use is bounded by the block duration. Frames are aligned on the start of the file, like in
+    load_voiced_chunks(), so the chunks are equivalent but not bit-identical: block-wise soxr resampling
+    differs slightly from librosa's (and from the 16-bit PCM cache), which can change VAD decisions on
+    borderline frames and hence chunk boundaries.
+    """
+    import soundfile as sf
+    import soxr
+    frame_samples = int(sample_rate * frame_duration)
+    chunk_samples = int(sample_rate * chunk_duration)
+    chunk = np.zeros(chunk_samples, dtype=np.float32)
+    chunk_length = 0
+    pending = np.zeros(0, dtype=np.float32)
+    with sf.SoundFile(file_path) as f:
+        resampler = soxr.ResampleStream(f.samplerate, sample_rate, 1, dtype='float32') if f.samplerate != sample_rate else None
+        block_frames = int(f.samplerate * block_duration)
+        last = False
+        while not last:
+            block = f.read(block_frames, dtype='float32', always_2d=True)
+            last = len(block) < block_frames
+            audio = block.mean(axis=1)
+            if resampler is not None:
+                audio = resampler.resample_chunk(audio, last=last)
+            # Samples that do not fill a whole VAD frame are kept for the next block.
+            audio = np.concatenate([pending, audio])
+            n = len(audio) // frame_samples * frame_samples
+            pending = audio[n:]
+            voiced = voiced_audio(audio[:n], vad, sample_rate)
+            i = 0
+            while i < len(voiced):
+                k = min(chunk_samples - chunk_length, len(voiced) - i)
+                chunk[chunk_length:chunk_length + k] = voiced[i:i + k]
+                chunk_length += k
+                i += k
+                if chunk_length == chunk_samples:
+                    yield chunk.copy()
+                    chunk_length = 0
+
+
+def is_out_of_memory(error):
+    return isinstance(error, MemoryError) or "out of memory" in str(error).lower()
+
+
+class SpeakerEmbeddingDataset(Dataset):
+    """Embeddings of the voiced 1 s chunks of a set of recordings, one recording (target) per speaker.
+
+    Embeddings are cached on disk (see embedding_cache.py): a run with unchanged audio and parameters
+    does not load the embedding model at all. Use cache_dir=None to disable the cache.
+
+    Files that are not in the cache are decoded and segmented by n_workers workers (default: one per
+    CPU, 0 to preprocess in the main process) while the main process computes the embeddings. Decoded
+    audio is kept as 16 kHz PCM in pcm_cache_dir (see pcm_cache.py), filled by a thread pool: each file
+    goes to the workers as soon as it is converted, and they memory-map it. With pcm_cache_dir=None,
+    every run decodes the files again in the workers.
+
+    Cache keys include the revision of the embedding model that load_embedder() uses (the embedding
+    service's, or the default checkpoint of the backend), unless model_revision is given.
+
+    Chunks are embedded in batches of batch_size chunks (one forward pass per batch). With
+    batch_size=None, batches start at max_batch_size chunks and are halved whenever a batch does not
+    fit in memory.
+    """
+    def __init__(self, file_paths, sample_rate=16000, chunk_duration=1.0, vad_mode=3, regression_model=False,
+                 backend="pyannote", model_revision=None, cache_dir=DEFAULT_CACHE_DIR, n_workers=None,
+                 batch_size=None, max_batch_size=64, verify_batching=True, pcm_cache_dir=DEFAULT_PCM_CACHE_DIR):
+        super(SpeakerEmbeddingDataset, self).__init__()
+        self.file_paths = file_paths
+        self.sample_rate = sample_rate
+        self.chunk_duration = chunk_duration
+        self.vad_mode = vad_mode
+        self.regression_model = regression_model
+        self.backend = backend
+        # Declared dimension of the embeddings (files without voiced audio have none).
+        self.dim = embedding_dim(backend)
+        self.model_revision = embedding_revision(backend=backend) if model_revision is None and cache_dir is not None else model_revision
+        self.n_workers = os.cpu_count() if n_workers is None else n_workers
+        self.auto_batch_size = batch_size is None
+        self.batch_size = max_batch_size if batch_size is None else batch_size
+        self.verify_batching = verify_batching
+        self.cache = EmbeddingCache(cache_dir) if cache_dir is not None else None
+        self.pcm_cache_dir = pcm_cache_dir
+        self.vad = webrtcvad.Vad(vad_mode)
+        self._embed = None
+        self.embeddings, self.targets = self.preprocess_files()
+
+    @property
+    def embed(self):
+        # The embedding model is only loaded on a cache miss.
+        if self._embed is None:
+            self._embed, _ = load_embedder(sample_rate=self.sample_rate, backend=self.backend)
+        return self._embed
+
+    def cache_key(self, file_path):
+        params = dict(sample_rate=self.sample_rate, vad_mode=self.vad_mode, frame_duration=frame_duration,
+                      chunk_duration=self.chunk_duration, backend=self.backend, model=self.model_revision)
+        if self.pcm_cache_dir is not None:
+            # Audio goes through 16-bit PCM: embeddings differ slightly from those of the decoded float audio.
+            params['audio_format'] = "pcm16"
+        return self.cache.key(file_path, **params)
+
+    def preprocess_files(self):
+        embeddings = [None] * len(self.file_paths)
+        keys = [None] * len(self.file_paths)
+        if self.cache is not None:
+            for i, file_path in enumerate(self.file_paths):
+                keys[i] = self.cache_key(file_path)
+                embeddings[i] = self.cache.load(keys[i])
+        missing = [i for i in range(len(self.file_paths)) if embeddings[i] is None]
+        for i, chunks in zip(missing, self.voiced_chunks([self.file_paths[i] for i in missing])):
+            embeddings[i] = self.embed_chunks(chunks)
+            if self.cache is not None:
+                embeddings[i] = self.cache.save(keys[i], embeddings[i])
+        targets = []
+        for i in range(len(self.file_paths)):
+            targets += [i] * len(embeddings[i])
+        non_empty = [e for e in embeddings if len(e) > 0]
+        if non_empty:
+            embeddings = np.concatenate(non_empty).astype(np.float32)
+        else:
+            embeddings = np.zeros((0, self.dim), dtype=np.float32)
+        targets = np.asarray(targets)
+        if self.regression_model:
+            targets = torch.from_numpy(targets).type(torch.FloatTensor)
+        else:
+            targets = torch.from_numpy(targets).type(torch.LongTensor)
+        return embeddings, targets
+
+    def voiced_chunks(self, file_paths):
+        """Yields the voiced chunks of each file, in order, decoding files in parallel."""
+        args = (self.sample_rate, self.chunk_duration, self.vad_mode, self.pcm_cache_dir)
+        if self.n_workers == 0 or len(file_paths) <= 1:
+            for file_path in file_paths:
+                yield load_voiced_chunks(file_path, *args)
+            return
+        # Training scripts have no __main__ guard: fork workers (where available) rather than spawn them,
+        # since spawned workers re-import the main script.
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+        with ProcessPoolExecutor(max_workers=min(self.n_workers, len(file_paths)), mp_context=context) as executor:
+            if self.pcm_cache_dir is None:
+                futures = [executor.submit(load_voiced_chunks, file_path, *args) for file_path in file_paths]
+                for future in futures:
+                    yield future.result()
+                return
+            # Decoding and resampling release the GIL: missing PCM files are converted by threads. The VAD
+            # does not, so each file goes to a worker process as soon as its PCM file is ready.
+            cache = PCMCache(self.pcm_cache_dir, self.sample_rate)
+            # Start the (forked) workers now, before the conversion threads exist.
+            executor.submit(int).result()
+            def convert(file_path):
+                cache.warm(file_path)
+                return executor.submit(load_voiced_chunks, file_path, *args)
+            with ThreadPoolExecutor(max_workers=self.n_workers) as threads:
+                conversions = [threads.submit(convert, file_path) for file_path in file_paths]
+                for conversion in conversions:
+                    yield conversion.result().result()
+
+    def embed_chunks(self, chunks):
+        """Embeddings of voiced chunks, as an (N, D) array."""
+        embeddings = []
+        i = 0
+        while i < len(chunks):
+            batch = chunks[i:i + self.batch_size]
+            try:
+                embeddings.append(np.asarray(self.embed(batch), dtype=np.float32))
+            except (RuntimeError, MemoryError) as e:
+                if not self.auto_batch_size or self.batch_size == 1 or not is_out_of_memory(e):
+                    raise
+                self.batch_size //= 2
+                print("Batch of {} chunks does not fit in memory: using batches of {}".format(len(batch), self.batch_size))
+                continue
+            if self.verify_batching:
+                self.check_batching(batch, embeddings[-1])
+            i += len(batch)
+        if not embeddings:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.concatenate(embeddings)
+
+    def check_batching(self, batch, embeddings, n=4, tolerance=1e-4):
+        # Once per dataset: batched embeddings must match chunk-by-chunk embeddings.
+        self.verify_batching = False
+        for chunk, embedding in zip(batch[:n], embeddings):
+            if not np.allclose(self.embed(chunk), embedding, rtol=tolerance, atol=tolerance):
+                raise RuntimeError("Batched embeddings differ from chunk-by-chunk embeddings")
+
+    def apply_vad(self, audio):
+        return voiced_audio(audio, self.vad, self.sample_rate)
+
+    def extract_chunks(self, audio):
+        return extract_chunks(audio, self.sample_rate, self.chunk_duration)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(self.embeddings[idx]), self.targets[idx]
+
+
+class StreamingSpeakerEmbeddingDataset(IterableDataset):
+    """Streaming version of SpeakerEmbeddingDataset for large voice corpora.
+
+    Yields (embedding, target) pairs without holding the recordings or the embeddings in memory: audio
+    is decoded in blocks and VAD and chunking run on the fly. A prefetching thread decodes ahead into a
+    bounded queue of prefetch chunks while the embedding model processes batches of batch_size chunks.
+    With shuffle_buffer > 0, embeddings are shuffled through a buffer of that size.
+
+    With a DataLoader using several workers, each worker streams its own subset of the files.
+    """
+    def __init__(self, file_paths, sample_rate=16000, chunk_duration=1.0, vad_mode=3, regression_model=False,
+                 backend="pyannote", batch_size=32, prefetch=256, shuffle_buffer=0, block_duration=10.0):
+        super(StreamingSpeakerEmbeddingDataset, self).__init__()
+        self.file_paths = file_paths
+        self.sample_rate = sample_rate
+        self.chunk_duration = chunk_duration
+        self.vad_mode = vad_mode
+        self.regression_model = regression_model
+        self.backend = backend
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.shuffle_buffer = shuffle_buffer
+        self.block_duration = block_duration
+        self._embed = None
+
+    @property
+    def embed(self):
+        if self._embed is None:
+            self._embed, _ = load_embedder(sample_rate=self.sample_rate, backend=self.backend)
+        return self._embed
+
+    def target(self, i):
+        return torch.tensor(i, dtype=torch.float32 if self.regression_model else torch.long)
+
+    def files(self):
+        # Targets are the indices of the files in file_paths, whichever worker streams them.
+        worker_info = get_worker_info()
+        indices = range(len(self.file_paths))
+        if worker_info is not None:
+            indices = indices[worker_info.id::worker_info.num_workers]
+        return [(i, self.file_paths[i]) for i in indices]
+
+    @staticmethod
+    def put(chunks, item, stop):
+        """Puts item in the queue unless stop is set first (the consumer has gone). Returns False if stopped."""
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(self, chunks, stop):
+        vad = webrtcvad.Vad(self.vad_mode)
+        try:
+            for i, file_path in self.files():
+                for chunk in stream_voiced_chunks(file_path, self.sample_rate, self.chunk_duration, vad, self.block_duration):
+                    if not self.put(chunks, (chunk, i), stop):
+                        return
+        except Exception as e:
+            self.put(chunks, e, stop)
+            return
+        self.put(chunks, None, stop)
+
+    def batches(self):
+        """Yields (embeddings, targets) batches."""
+        chunks = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        producer = threading.Thread(target=self.produce, args=(chunks, stop), daemon=True)
+        producer.start()
+        try:
+            done = False
+            while not done:
+                # Wait for one chunk, then take whatever else is ready, up to a full batch.
+                batch = [chunks.get()]
+                while len(batch) < self.batch_size and not isinstance(batch[-1], (Exception, type(None))):
+                    try:
+                        batch.append(chunks.get_nowait())
+                    except queue.Empty:
+                        break
+                if isinstance(batch[-1], Exception):
+                    raise batch[-1]
+                if batch[-1] is None:
+                    done = True
+                    batch.pop()
+                if batch:
+                    embeddings = np.asarray(self.embed(np.stack([chunk for chunk, i in batch])), dtype=np.float32)
+                    yield embeddings, [i for chunk, i in batch]
+        finally:
+            stop.set()
+
+    def __iter__(self):
+        buffer = []
+        for embeddings, targets in self.batches():
+            for embedding, i in zip(embeddings, targets):
+                item = (torch.from_numpy(embedding), self.target(i))
+                if self.shuffle_buffer <= 0:
+                    yield item
+                elif len(buffer) < self.shuffle_buffer:
+                    buffer.append(item)
+                else:
+                    j = random.randrange(len(buffer))
+                    yield buffer[j]
+                    buffer[j] = item
+        random.shuffle(buffer)
+        yield from buffer
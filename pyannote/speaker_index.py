@@ -0,0 +1,203 @@
+"""Enrolled-speaker index.
+
+Stores one normalized centroid per enrolled speaker in a float32 matrix. A new
+embedding is identified with a single matrix-vector product (cosine similarity
+with every centroid); speakers whose best similarity is below the threshold are
+rejected as unknown. Speakers can be enrolled or removed without retraining.
+The pleasure of each speaker (see speaker_stream.py) is stored by name with it,
+and the embedding backend of the index (see embedding_backends.py) with the index.
+
+    python speaker_index.py enroll 1-Victor "./Voices/VOIX TELEO 1-Victor.wav" --pleasure 1
+    python speaker_index.py set-pleasure 1-Victor 0.5
+    python speaker_index.py identify ./Voices/split/some_clip.wav
+    python speaker_index.py remove 1-Victor
+    python speaker_index.py list
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+class SpeakerIndex:
+    def __init__(self, dim=512, threshold=0.5, capacity=16, backend="pyannote"):
+        self.dim = dim
+        self.threshold = threshold
+        # Embeddings of every speaker must come from this backend.
+        self.backend = backend
+        self.names = []
+        # Rows [0, len(names)) are in use. The matrix grows by doubling when full.
+        self.centroids = np.zeros((capacity, dim), dtype=np.float32)
+        # Sum of normalized enrollment embeddings, so that enrollment can be done incrementally.
+        self.sums = np.zeros((capacity, dim), dtype=np.float32)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        # Pleasure of each speaker, by name (speakers may have none).
+        self.pleasures = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def _grow(self):
+        capacity = 2 * len(self.centroids)
+        for attr in ['centroids', 'sums', 'counts']:
+            old = getattr(self, attr)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, attr, new)
+
+    def enroll(self, name, embeddings, pleasure=None):
+        """Adds (or updates) a speaker from one or more (D,) embeddings, optionally setting its pleasure."""
+        embeddings = normalize(np.atleast_2d(embeddings))
+        if embeddings.shape[1] != self.dim:
+            raise ValueError("Expected embeddings of dimension {}, got {}".format(self.dim, embeddings.shape[1]))
+        if name in self.names:
+            i = self.names.index(name)
+        else:
+            if len(self.names) == len(self.centroids):
+                self._grow()
+            i = len(self.names)
+            self.names.append(name)
+            self.sums[i] = 0
+            self.counts[i] = 0
+        self.sums[i] += embeddings.sum(axis=0)
+        self.counts[i] += len(embeddings)
+        self.centroids[i] = normalize(self.sums[i])
+        if pleasure is not None:
+            self.pleasures[name] = float(pleasure)
+
+    def set_pleasure(self, name, pleasure):
+        if name not in self.names:
+            raise KeyError("No speaker named {}".format(name))
+        self.pleasures[name] = float(pleasure)
+
+    def remove(self, name):
+        """Removes a speaker. The following rows are shifted up so that the order of speakers is preserved."""
+        if name not in self.names:
+            raise KeyError("No speaker named {}".format(name))
+        i = self.names.index(name)
+        n = len(self.names)
+        for attr in ['centroids', 'sums', 'counts']:
+            array = getattr(self, attr)
+            array[i:n - 1] = array[i + 1:n]
+            array[n - 1] = 0
+        self.names.pop(i)
+        self.pleasures.pop(name, None)
+
+    def scores(self, embeddings):
+        """Cosine similarity between embeddings ((D,) or (N, D)) and every enrolled centroid."""
+        return normalize(embeddings) @ self.centroids[:len(self.names)].T
+
+    def identify(self, embedding):
+        """Returns (name, score) of the closest speaker, or (None, score) if it is below the threshold."""
+        if not self.names:
+            return None, 0.0
+        scores = self.centroids[:len(self.names)] @ normalize(embedding)
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+        return (self.names[best] if score >= self.threshold else None), score
+
+    def identify_batch(self, embeddings):
+        """Identifies (N, D) embeddings. Returns a list of names (None if unknown) and an array of scores."""
+        if not self.names:
+            return [None] * len(embeddings), np.zeros(len(embeddings), dtype=np.float32)
+        scores = self.scores(embeddings)
+        best = scores.argmax(axis=1)
+        best_scores = scores[np.arange(len(best)), best]
+        names = [self.names[b] if s >= self.threshold else None for b, s in zip(best, best_scores)]
+        return names, best_scores
+
+    def save(self, filename):
+        n = len(self.names)
+        # Write to a temporary file first so that a crash never leaves a corrupted index.
+        tmp_filename = filename + ".tmp.npz"
+        np.savez(tmp_filename, names=np.array(self.names, dtype=str), sums=self.sums[:n], counts=self.counts[:n],
+                 threshold=self.threshold, backend=self.backend,
+                 pleasures=np.array([self.pleasures.get(name, np.nan) for name in self.names], dtype=np.float32))
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        names = list(data['names'])
+        sums = data['sums']
+        # Indexes saved before the backend was stored were enrolled with pyannote.
+        backend = str(data['backend']) if 'backend' in data else "pyannote"
+        index = cls(dim=sums.shape[1], threshold=float(data['threshold']), capacity=max(16, len(names)), backend=backend)
+        n = len(names)
+        index.names = [str(name) for name in names]
+        index.sums[:n] = sums
+        index.counts[:n] = data['counts']
+        index.centroids[:n] = normalize(sums)
+        if 'pleasures' in data:
+            index.pleasures = { name: float(p) for name, p in zip(index.names, data['pleasures']) if not np.isnan(p) }
+        return index
+
+
+def load_chunks(filename, sample_rate=16000, chunk_duration=1.0):
+    import librosa
+    audio, sr = librosa.load(filename, sr=sample_rate)
+    chunk_samples = int(sample_rate * chunk_duration)
+    chunks = [audio[i:i + chunk_samples] for i in range(0, len(audio) - chunk_samples + 1, chunk_samples)]
+    return np.stack(chunks) if chunks else audio[np.newaxis]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--index", type=str, help="Speaker index filename", default="speakers.npz")
+    parser.add_argument("--threshold", type=float, help="Minimum cosine similarity of a known speaker (new index)", default=0.5)
+    parser.add_argument("--backend", type=str, help="Embedding backend (new index)", default="pyannote")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    enroll_parser = subparsers.add_parser("enroll", help="Enroll a speaker from audio files")
+    enroll_parser.add_argument("name")
+    enroll_parser.add_argument("files", nargs="+")
+    enroll_parser.add_argument("--pleasure", type=float, help="Pleasure of the speaker", default=None)
+    pleasure_parser = subparsers.add_parser("set-pleasure", help="Set the pleasure of a speaker")
+    pleasure_parser.add_argument("name")
+    pleasure_parser.add_argument("pleasure", type=float)
+    remove_parser = subparsers.add_parser("remove", help="Remove a speaker")
+    remove_parser.add_argument("name")
+    identify_parser = subparsers.add_parser("identify", help="Identify the speaker of audio files")
+    identify_parser.add_argument("files", nargs="+")
+    subparsers.add_parser("list", help="List enrolled speakers")
+    args = parser.parse_args()
+
+    if os.path.exists(args.index):
+        index = SpeakerIndex.load(args.index)
+    else:
+        from embedding_backends import embedding_dim
+        index = SpeakerIndex(embedding_dim(args.backend), threshold=args.threshold, backend=args.backend)
+
+    if args.command == "list":
+        for name, count in zip(index.names, index.counts):
+            pleasure = index.pleasures.get(name)
+            print("{} ({} embeddings, pleasure {})".format(name, count, "-" if pleasure is None else "{:+.2f}".format(pleasure)))
+    elif args.command in ("remove", "set-pleasure"):
+        try:
+            if args.command == "remove":
+                index.remove(args.name)
+            else:
+                index.set_pleasure(args.name, args.pleasure)
+        except KeyError as e:
+            sys.exit(e.args[0])
+        index.save(args.index)
+    else:
+        from embedding_service import load_embedder
+        embed, embed_file = load_embedder(backend=index.backend)
+        if args.command == "enroll":
+            for f in args.files:
+                index.enroll(args.name, embed(load_chunks(f)), args.pleasure)
+            index.save(args.index)
+            print("Enrolled {} ({} speakers)".format(args.name, len(index)))
+        else:
+            for f in args.files:
+                name, score = index.identify(embed_file(f))
+                print("{}: {} ({:.3f})".format(f, name if name is not None else "unknown", score))
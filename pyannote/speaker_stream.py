@@ -0,0 +1,390 @@
+"""Streaming speaker classifier.
+
+Microphone -> VAD -> embedding -> trustnet -> /pleasure over OSC.
+
+The trustnet model (see trustnet_artifact.py) is loaded once in inference mode,
+with the embedding backend it was trained on. Class probabilities are
+mapped to a pleasure value in [-1, +1], which is sent to the agent (teleo.py)
+as /pleasure. Alternatively, speakers can be identified with an enrolled
+speaker index (speaker_index.py) instead of trustnet.
+
+Chunks that cannot be published within max_latency seconds of their capture
+are dropped, so that the agent never receives stale pleasure. Per-stage
+latencies are printed on exit, or at any time with kill -USR1 <pid>.
+
+With --online-training, confidently classified live embeddings fine-tune trustnet
+in a background thread (online_training.py) and the updated weights replace the
+live model without interrupting inference.
+
+    python speaker_stream.py --model trustnet.pt --speaker-pleasure 1 0.3 -0.3 -1
+    python speaker_stream.py --index speakers.npz
+    python speaker_stream.py --model trustnet.pt --online-training --save-model trustnet-online.pt
+"""
+import argparse
+import collections
+import queue
+import time
+
+import numpy as np
+import torch
+import webrtcvad
+from pythonosc import udp_client
+
+from embedding_service import load_embedder
+from latency import PipelineMonitor, capture_time as adc_capture_time
+from load_control import LoadController
+from online_training import OnlineTrainer
+from sampling_profiler import SamplingProfiler, serve_osc, PROFILE_PORT
+from speaker_index import SpeakerIndex
+from trustnet_artifact import load_trustnet, save_trustnet
+
+# Agent's OSC receive port (see Agent in main/teleo.py).
+AGENT_IP = "127.0.0.1"
+AGENT_PORT = 8001
+
+
+class SpeakerStream:
+    def __init__(self, model_filename='trustnet.pt', speaker_pleasure=None, regression_model=None,
+                 osc_ip=AGENT_IP, osc_port=AGENT_PORT, sample_rate=16000, duration=1.0,
+                 frame_duration=0.02, vad_mode=3, max_latency=1.0, max_queue_size=4, device=None,
+                 index_filename=None, unknown_pleasure=0.0, online_training=False, min_confidence=0.9,
+                 hop=None, batch_size=1):
+        self.sample_rate = sample_rate
+        self.frame_samples = int(sample_rate * frame_duration)
+        self.chunk_samples = int(sample_rate * duration)
+        self.max_latency = max_latency
+        # Chunks start every hop seconds of voiced audio (default: back to back). Up to batch_size queued
+        # chunks are embedded together.
+        self.set_hop(duration if hop is None else hop)
+        self.batch_size = batch_size
+        # 2: print every chunk, 1: print a summary every 10 chunks, 0: quiet.
+        self.verbosity = 2
+
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        if index_filename is not None:
+            # Identify speakers with the enrolled speaker index instead of trustnet.
+            self.model = None
+            self.index = SpeakerIndex.load(index_filename)
+            self.unknown_pleasure = unknown_pleasure
+            self.metadata = None
+            self.regression_model = False
+            n_speakers = len(self.index)
+            backend = self.index.backend
+        else:
+            # regression_model=None takes the type of the model from the file, otherwise it is checked.
+            self.model, self.metadata = load_trustnet(model_filename, self.device, regression_model=regression_model)
+            self.index = None
+            self.regression_model = self.metadata['architecture']['regression_model']
+            n_speakers = len(self.metadata['speakers'])
+            backend = self.metadata['embedding']['backend']
+        self.embed, _ = load_embedder(sample_rate=sample_rate, backend=backend)
+
+        self.trainer = None
+        if online_training:
+            if self.model is None:
+                raise ValueError("Online training requires a trustnet model")
+            self.trainer = OnlineTrainer(self.model, self.regression_model, on_update=self.set_model,
+                                         min_confidence=min_confidence, n_classes=n_speakers)
+
+        if self.index is not None:
+            # Pleasure by speaker name: given in the order of the index, or stored in it.
+            if speaker_pleasure is None:
+                self.index_pleasure = dict(self.index.pleasures)
+            elif len(speaker_pleasure) != n_speakers:
+                raise ValueError("{} speaker pleasure values given for {} speakers".format(len(speaker_pleasure), n_speakers))
+            else:
+                self.index_pleasure = { name: float(p) for name, p in zip(self.index.names, speaker_pleasure) }
+            missing = [name for name in self.index.names if name not in self.index_pleasure]
+            if missing:
+                raise ValueError("No pleasure for speakers {} (set it with speaker_index.py set-pleasure, "
+                                 "or give --speaker-pleasure)".format(", ".join(missing)))
+            speaker_pleasure = [self.index_pleasure[name] for name in self.index.names]
+        # Pleasure associated with each speaker class. By default pleasure decreases linearly with
+        # the speaker index, like the targets of the regression model.
+        if speaker_pleasure is None:
+            speaker_pleasure = np.linspace(1, -1, n_speakers)
+        elif len(speaker_pleasure) != n_speakers:
+            raise ValueError("{} speaker pleasure values given for {} speakers".format(len(speaker_pleasure), n_speakers))
+        self.speaker_pleasure = np.asarray(speaker_pleasure, dtype=np.float32)
+
+        self.vad = webrtcvad.Vad(vad_mode)
+        self.client = udp_client.SimpleUDPClient(osc_ip, osc_port)
+
+        # Voiced audio accumulates in a preallocated buffer until a full chunk is available.
+        self.buffer = np.zeros(self.chunk_samples, dtype=np.float32)
+        self.buffer_length = 0
+        self.buffer_start_time = None
+        # (offset in the buffer, capture time) of the frames in the buffer, to date retained overlaps.
+        self.buffer_times = []
+        # Voiced samples to skip before the next chunk (when hop is longer than a chunk).
+        self.skip = 0
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        # Statistics.
+        self.monitor = PipelineMonitor()
+        self.latencies = collections.deque(maxlen=1000)
+        self.n_published = 0
+
+    def set_hop(self, hop):
+        """Sets the duration of voiced audio between the starts of consecutive chunks, in seconds."""
+        self.hop_samples = max(self.frame_samples, int(self.sample_rate * hop))
+
+    def audio_callback(self, indata, frames, time_info, status):
+        """sounddevice callback: called for each audio frame from the microphone."""
+        capture_time, callback_time = adc_capture_time(time_info)
+        self.monitor.record('capture', capture_time, callback_time)
+        if status:
+            if status.input_overflow or status.input_underflow:
+                self.monitor.xrun()
+            print(status)
+        if frames == self.frame_samples:  # Ensure frame size is as expected
+            self.feed(indata[:, 0], capture_time, callback_time)
+
+    def feed(self, frame, capture_time=None, callback_time=None):
+        """Runs VAD on one frame and queues a chunk for inference when the buffer is full.
+
+        capture_time: ADC time of the frame, callback_time: when the audio callback received it
+        (both default to now).
+        """
+        if capture_time is None:
+            capture_time = time.perf_counter()
+        if callback_time is None:
+            callback_time = capture_time
+        is_speech = self.vad.is_speech((frame * 32767).astype(np.int16).tobytes(), self.sample_rate)
+        vad_time = time.perf_counter()
+        self.monitor.record('vad', callback_time, vad_time)
+        if not is_speech:
+            return
+        # The load controller may change the hop from the inference thread: read it once.
+        hop = self.hop_samples
+        if self.skip > 0:
+            k = min(self.skip, len(frame))
+            self.skip -= k
+            frame = frame[k:]
+            if len(frame) == 0:
+                return
+        if self.buffer_length == 0:
+            self.buffer_start_time = capture_time
+        self.buffer_times.append((self.buffer_length, capture_time))
+        n = min(len(frame), self.chunk_samples - self.buffer_length)
+        self.buffer[self.buffer_length:self.buffer_length + n] = frame[:n]
+        self.buffer_length += n
+        if self.buffer_length == self.chunk_samples:
+            complete_time = time.perf_counter()
+            self.monitor.record('buffer', self.buffer_start_time, complete_time)
+            self.enqueue(self.buffer.copy(), capture_time, complete_time)
+            remainder = frame[n:]
+            if hop < self.chunk_samples:
+                # Overlapping chunks: the next chunk starts with the end of this one, which was captured
+                # with the frame holding sample hop.
+                self.buffer_length = self.chunk_samples - hop
+                self.buffer[:self.buffer_length] = self.buffer[hop:]
+                first = max(i for i, (offset, t) in enumerate(self.buffer_times) if offset <= hop)
+                self.buffer_times = [(max(0, offset - hop), t) for offset, t in self.buffer_times[first:]]
+                self.buffer_start_time = self.buffer_times[0][1]
+            else:
+                self.buffer_length = 0
+                self.buffer_times = []
+                self.skip = hop - self.chunk_samples
+                k = min(self.skip, len(remainder))
+                self.skip -= k
+                remainder = remainder[k:]
+            # Keep the remainder of the frame for the next chunk.
+            if len(remainder) > 0:
+                if self.buffer_length == 0:
+                    self.buffer_start_time = capture_time
+                self.buffer_times.append((self.buffer_length, capture_time))
+                self.buffer[self.buffer_length:self.buffer_length + len(remainder)] = remainder
+                self.buffer_length += len(remainder)
+
+    def enqueue(self, chunk, capture_time, complete_time=None):
+        # If inference is late, drop the oldest chunk rather than building up latency.
+        while True:
+            try:
+                self.queue.put_nowait((chunk, capture_time, complete_time or capture_time))
+                break
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.monitor.drop()
+                except queue.Empty:
+                    pass
+        self.monitor.record_queue_depth(self.queue_depth())
+
+    def dequeue(self, timeout=0.1):
+        """Next queued (chunk, capture time, complete time), or None if none is queued within timeout."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def publish(self, pleasure, capture_time):
+        """Sends the pleasure computed for a chunk captured at capture_time to the agent."""
+        self.client.send_message("/pleasure", pleasure)
+
+    def pleasure(self, output):
+        """Maps the trustnet output to a pleasure value in [-1, +1]. Returns (pleasure, probabilities)."""
+        if self.regression_model:
+            # Regression output is a (fractional) speaker index.
+            index = float(output[0])
+            return float(np.interp(index, np.arange(len(self.speaker_pleasure)), self.speaker_pleasure)), None
+        probabilities = output / max(output.sum(), 1e-6)
+        return float(np.clip(probabilities @ self.speaker_pleasure, -1, +1)), probabilities
+
+    def process(self, chunk):
+        """Computes the pleasure for a chunk of voiced audio. Returns (pleasure, probabilities)."""
+        return self.classify(self.embed(chunk))
+
+    def classify(self, embedding):
+        """Computes the pleasure for an embedding. Returns (pleasure, probabilities)."""
+        if self.index is not None:
+            name, score = self.index.identify(embedding)
+            if name is None:
+                return self.unknown_pleasure, None
+            probabilities = np.zeros(len(self.index), dtype=np.float32)
+            probabilities[self.index.names.index(name)] = 1
+            return self.index_pleasure[name], probabilities
+        return self.pleasure(self.infer(embedding))
+
+    def infer(self, embedding):
+        """Raw trustnet output for an embedding."""
+        # Read the model reference once: online training may replace it at any time.
+        model = self.model
+        with torch.inference_mode():
+            output = model(torch.from_numpy(np.asarray(embedding, dtype=np.float32)).to(self.device))
+        return output.cpu().numpy()
+
+    def set_model(self, model):
+        """Replaces the live trustnet model (called by online training)."""
+        self.model = model
+
+    def step(self, timeout=0.1):
+        """Processes the next queued chunks (up to batch_size), if any, and publishes their pleasure.
+
+        Returns (pleasure, probabilities) of the last published chunk, or None.
+        """
+        item = self.dequeue(timeout)
+        if item is None:
+            return None
+        items = [item]
+        while len(items) < self.batch_size:
+            item = self.dequeue(0)
+            if item is None:
+                break
+            items.append(item)
+        dequeue_time = time.perf_counter()
+        self.monitor.record_queue_depth(self.queue_depth())
+        fresh = []
+        for chunk, capture_time, complete_time in items:
+            self.monitor.record('queue', complete_time, dequeue_time)
+            if dequeue_time - capture_time > self.max_latency:
+                self.monitor.drop()
+            else:
+                fresh.append((chunk, capture_time))
+        if not fresh:
+            return None
+        if len(fresh) == 1:
+            embeddings = [self.embed(fresh[0][0])]
+        else:
+            embeddings = self.embed(np.stack([chunk for chunk, capture_time in fresh]))
+        embedding_time = time.perf_counter()
+        result = None
+        for (chunk, capture_time), embedding in zip(fresh, embeddings):
+            self.monitor.record('embedding', dequeue_time, embedding_time)
+            if self.trainer is not None:
+                output = self.infer(embedding)
+                self.trainer.observe(embedding, output)
+                pleasure, probabilities = self.pleasure(output)
+            else:
+                pleasure, probabilities = self.classify(embedding)
+            classification_time = time.perf_counter()
+            self.monitor.record('classification', embedding_time, classification_time)
+            self.monitor.record('total', capture_time, classification_time)
+            latency = classification_time - capture_time
+            if latency > self.max_latency:
+                self.monitor.drop()
+                continue
+            self.publish(pleasure, capture_time)
+            self.latencies.append(latency)
+            self.n_published += 1
+            result = pleasure, probabilities
+        return result
+
+    def latency_report(self):
+        if not self.latencies:
+            return "no chunk published ({} dropped)".format(self.monitor.dropped)
+        latencies = np.asarray(self.latencies) * 1000
+        return "mic-to-OSC latency p50 = {:.1f} ms p95 = {:.1f} ms max = {:.1f} ms ({} published, {} dropped)".format(
+            np.percentile(latencies, 50), np.percentile(latencies, 95), latencies.max(), self.n_published, self.monitor.dropped)
+
+    def run(self, verbose=True, controller=None, profile_port=PROFILE_PORT):
+        """Records from the microphone and publishes pleasure until interrupted.
+
+        controller: optional LoadController (load_control.py), updated from the loop.
+        profile_port: OSC port for /profile/start and /profile/stop (None to disable).
+        """
+        import sounddevice as sd
+        self.verbosity = 2 if verbose else 0
+        profiler = SamplingProfiler("speaker-stream")
+        # Another stream may already listen on the port: serve_osc() then returns None.
+        profile_server = serve_osc(profiler, profile_port) if profile_port is not None else None
+        self.monitor.install_signal_handler()
+        if self.trainer is not None:
+            self.trainer.start()
+        with sd.InputStream(samplerate=self.sample_rate, channels=1, callback=self.audio_callback, blocksize=self.frame_samples):
+            print("Recording... Press Ctrl+C to stop.")
+            try:
+                while True:
+                    result = self.step()
+                    if controller is not None:
+                        controller.update()
+                    if result is not None and self.verbosity >= 2:
+                        pleasure, probabilities = result
+                        print("pleasure: {:+.3f} probabilities: {} | {}".format(pleasure, probabilities, self.latency_report()))
+                    elif result is not None and self.verbosity == 1 and self.n_published % 10 == 0:
+                        print(self.latency_report())
+            except KeyboardInterrupt:
+                print("Stopped recording.")
+                print(self.latency_report())
+                print(self.monitor.report())
+            finally:
+                if profile_server is not None:
+                    profile_server.shutdown()
+                    profile_server.server_close()
+                profiler.stop()
+                if self.trainer is not None:
+                    self.trainer.stop()
+                    print(self.trainer.report())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model", type=str, help="Classification/regression model filename", default="trustnet.pt")
+    parser.add_argument("--regression-model", help="Check that the model is (not) a regression model (default: any)", default=None, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--index", type=str, help="Enrolled speaker index (replaces the model)", default=None)
+    parser.add_argument("--unknown-pleasure", type=float, help="Pleasure for unknown speakers (with --index)", default=0.0)
+    parser.add_argument("--speaker-pleasure", type=float, nargs="+", help="Pleasure for each speaker class", default=None)
+    parser.add_argument("--duration", type=float, help="Duration of voiced audio per chunk in seconds", default=1.0)
+    parser.add_argument("--max-latency", type=float, help="Maximum mic-to-OSC latency in seconds", default=1.0)
+    parser.add_argument("--online-training", help="Fine-tune the model on confidently classified live speech", default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--min-confidence", type=float, help="Minimum confidence of the embeddings used for online training", default=0.9)
+    parser.add_argument("--save-model", type=str, help="Where to save the fine-tuned model on exit (with --online-training)", default=None)
+    parser.add_argument("--latency-budget", type=float, help="Shed load (hop, batch size, verbosity) above this latency in seconds", default=None)
+    parser.add_argument("--profile-port", type=int, help="OSC port for /profile/start and /profile/stop", default=PROFILE_PORT)
+    parser.add_argument("--ip", type=str, help="Agent IP", default=AGENT_IP)
+    parser.add_argument("--port", type=int, help="Agent OSC port", default=AGENT_PORT)
+    args = parser.parse_args()
+
+    stream = SpeakerStream(args.model, args.speaker_pleasure, args.regression_model, args.ip, args.port,
+                           duration=args.duration, max_latency=args.max_latency,
+                           index_filename=args.index, unknown_pleasure=args.unknown_pleasure,
+                           online_training=args.online_training, min_confidence=args.min_confidence)
+    controller = LoadController(stream, latency_budget=args.latency_budget) if args.latency_budget is not None else None
+    stream.run(controller=controller, profile_port=args.profile_port)
+    if args.online_training and args.save_model is not None:
+        save_trustnet(stream.model, args.save_model, stream.metadata['speakers'],
+                      stream.metadata['embedding']['backend'], stream.metadata['embedding']['model'])
+        print("Fine-tuned model saved to {}".format(args.save_model))
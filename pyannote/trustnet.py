@@ -0,0 +1,129 @@
+"""Trustnet: classifier (or regressor) of speaker embeddings, and its training engine.
+
+The training engine keeps the whole embedding set in memory as tensors and
+draws shuffled mini-batches by indexing (or takes full-batch steps), without a
+DataLoader. Training stops early when the validation loss stops improving and
+the best weights are restored.
+"""
+import copy
+import time
+
+import torch
+from torch import nn
+
+
+def build_trustnet(input_dim=512, n_classes=4, hidden_dim=32, hidden_dim2=16, regression_model=False):
+    # Create a classifier model with one hidden layer with RELU activation, for classifying the speaker vectors.
+    if regression_model:
+        return nn.Sequential(
+            nn.Linear(input_dim, hidden_dim),
+            nn.ReLU(),
+            nn.Linear(hidden_dim, hidden_dim2),
+            nn.Sigmoid(),
+            nn.Linear(hidden_dim2, 1))
+    else:
+        return nn.Sequential(
+            nn.Linear(input_dim, hidden_dim),
+            nn.ReLU(),
+            nn.Linear(hidden_dim, n_classes),
+            nn.Sigmoid())
+
+
+def split(X, y, fraction, generator=None):
+    """Random split of (X, y) into (X_a, y_a), (X_b, y_b) where a holds the given fraction of the items."""
+    permutation = torch.randperm(len(X), generator=generator)
+    n = int(fraction * len(X))
+    return (X[permutation[:n]], y[permutation[:n]]), (X[permutation[n:]], y[permutation[n:]])
+
+
+def compute_loss(criterion, outputs, labels):
+    # Regression outputs are (N, 1) while labels are (N,).
+    if outputs.dim() == 2 and outputs.shape[1] == 1 and labels.dim() == 1:
+        outputs = outputs.squeeze(1)
+    return criterion(outputs, labels)
+
+
+def train(model, criterion, optimizer, X_train, y_train, X_val=None, y_val=None, epochs=1000, batch_size=None,
+          patience=50, min_delta=0.0, log_every=50, generator=None):
+    """Trains model on tensors X_train, y_train.
+
+    batch_size=None takes one full-batch step per epoch. Validation loss on X_val, y_val is computed
+    after each epoch; training stops after patience epochs without improvement by more than min_delta,
+    and the weights of the best epoch are restored.
+
+    Returns a dict with the number of epochs run, the best epoch and validation loss, and epochs/sec.
+    """
+    n = len(X_train)
+    if n == 0:
+        raise ValueError("No training data: the training set is empty")
+    if batch_size is None or batch_size >= n:
+        batch_size = n
+    validate = X_val is not None and len(X_val) > 0
+    best_loss = float('inf')
+    best_epoch = 0
+    best_state = None
+    # epochs=0 runs no epoch.
+    epoch = -1
+    startTime = time.perf_counter()
+    for epoch in range(epochs):
+        model.train()
+        running_loss = torch.zeros(())
+        permutation = torch.randperm(n, generator=generator) if batch_size < n else None
+        for start in range(0, n, batch_size):
+            if permutation is None:
+                inputs, labels = X_train, y_train
+            else:
+                indices = permutation[start:start + batch_size]
+                inputs, labels = X_train[indices], y_train[indices]
+            # set optimizer to zero grad to remove previous epoch gradients
+            optimizer.zero_grad(set_to_none=True)
+            loss = compute_loss(criterion, model(inputs), labels)
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.detach() * len(inputs)
+        train_loss = running_loss.item() / n
+
+        if validate:
+            model.eval()
+            with torch.no_grad():
+                val_loss = compute_loss(criterion, model(X_val), y_val).item()
+        else:
+            val_loss = train_loss
+        if val_loss < best_loss - min_delta:
+            best_loss = val_loss
+            best_epoch = epoch
+            best_state = copy.deepcopy(model.state_dict())
+
+        # display statistics
+        if log_every and (epoch + 1) % log_every == 0:
+            print(f'[{epoch + 1}] train loss: {train_loss:.5f} validation loss: {val_loss:.5f}')
+
+        if epoch - best_epoch >= patience:
+            print(f'Early stopping at epoch {epoch + 1}: best validation loss {best_loss:.5f} at epoch {best_epoch + 1}')
+            break
+
+    elapsed = max(time.perf_counter() - startTime, 1e-9)
+    if best_state is not None:
+        model.load_state_dict(best_state)
+    model.eval()
+    epochs_run = epoch + 1
+    print(f'Trained {epochs_run} epochs in {elapsed:.2f} s ({epochs_run / elapsed:.1f} epochs/s)')
+    return { 'epochs': epochs_run, 'best_epoch': best_epoch + 1, 'best_loss': best_loss,
+             'epochs_per_second': epochs_run / elapsed }
+
+
+def accuracy(model, X, y, regression_model=False, n_classes=None):
+    """Accuracy on X, y, as computed by the training scripts (fraction between 0 and 1)."""
+    if len(X) == 0:
+        return float('nan')
+    model.eval()
+    # no need to calculate gradients during inference
+    with torch.no_grad():
+        outputs = model(X)
+        if regression_model:
+            predicted = torch.round(outputs).flatten()
+            correct = len(y) - torch.abs(predicted - y).sum().item() / n_classes
+        else:
+            predicted = outputs.argmax(dim=1)
+            correct = (predicted == y).sum().item()
+    return correct / len(y)
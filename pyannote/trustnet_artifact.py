@@ -0,0 +1,167 @@
+"""Versioned file format of trained trustnet models.
+
+A trustnet file holds everything needed to rebuild the model and check that it
+matches the embeddings it is fed, without pickling Python objects:
+
+  magic "TRUSTNET" | format version (uint32) | header length (uint32) | JSON header | padding | weights
+
+The JSON header describes the architecture (see build_trustnet), the speaker
+labels, the embedding backend and model, and the offset, dtype and shape of
+each weight tensor. Weights are stored little-endian, each aligned on 64 bytes,
+and are memory-mapped when loading.
+
+    save_trustnet(model, "trustnet.pt", speakers, backend="pyannote", embedding_model="pyannote/embedding")
+    model, metadata = load_trustnet("trustnet.pt", backend="pyannote")
+
+Models saved by older versions of the training scripts (pickled modules or
+state dicts) can be converted:
+
+    python trustnet_artifact.py convert old.pt trustnet.pt --speakers 1-Victor 2-Sofian 3-Etienne 4-Natalia
+"""
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+import torch
+
+from trustnet import build_trustnet
+
+MAGIC = b"TRUSTNET"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<8sII")
+ALIGNMENT = 64
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def architecture(state_dict):
+    """build_trustnet arguments of the model with the given state dict."""
+    shapes = { name: tuple(tensor.shape) for name, tensor in state_dict.items() }
+    input_dim = shapes['0.weight'][1]
+    hidden_dim = shapes['0.weight'][0]
+    if '4.weight' in shapes:
+        # Linear, ReLU, Linear, Sigmoid, Linear(1): regression model.
+        return { 'input_dim': input_dim, 'n_classes': None, 'hidden_dim': hidden_dim,
+                 'hidden_dim2': shapes['2.weight'][0], 'regression_model': True }
+    return { 'input_dim': input_dim, 'n_classes': shapes['2.weight'][0], 'hidden_dim': hidden_dim,
+             'hidden_dim2': None, 'regression_model': False }
+
+
+def save_trustnet(model, filename, speakers, backend, embedding_model=None):
+    """Saves trustnet model with its speaker labels and the embedding backend (and model) it was trained on."""
+    state_dict = { name: tensor.detach().cpu().contiguous() for name, tensor in model.state_dict().items() }
+    config = architecture(state_dict)
+    if not config['regression_model'] and config['n_classes'] != len(speakers):
+        raise ValueError("Model has {} classes but {} speakers are given".format(config['n_classes'], len(speakers)))
+
+    tensors = []
+    offset = 0
+    for name, tensor in state_dict.items():
+        array = tensor.numpy().astype(tensor.numpy().dtype.newbyteorder("<"), copy=False)
+        tensors.append({ 'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape),
+                         'offset': offset, 'nbytes': array.nbytes })
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({ 'architecture': config, 'speakers': list(speakers),
+                          'embedding': { 'backend': backend, 'model': embedding_model },
+                          'tensors': tensors }).encode("utf-8")
+    data_offset = _align(PREAMBLE.size + len(header))
+
+    # Write to a temporary file first so that a running pipeline never reads a partial model.
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for (name, tensor), description in zip(state_dict.items(), tensors):
+            f.seek(data_offset + description['offset'])
+            f.write(tensor.numpy().astype(description['dtype'], copy=False).tobytes())
+        f.truncate(data_offset + offset)
+    os.replace(tmp_filename, filename)
+
+
+def read_metadata(filename):
+    """JSON header of a trustnet file, with the offset of its weights added as 'data_offset'."""
+    with open(filename, "rb") as f:
+        preamble = f.read(PREAMBLE.size)
+        if len(preamble) < PREAMBLE.size or not preamble.startswith(MAGIC):
+            raise ValueError("{} is not a trustnet file. Models saved by older versions can be converted with: "
+                             "python trustnet_artifact.py convert {} <new file> --speakers ...".format(filename, filename))
+        magic, version, header_length = PREAMBLE.unpack(preamble)
+        if version > FORMAT_VERSION:
+            raise ValueError("{} has format version {}, this version only reads up to {}".format(filename, version, FORMAT_VERSION))
+        metadata = json.loads(f.read(header_length).decode("utf-8"))
+    metadata['data_offset'] = _align(PREAMBLE.size + header_length)
+    return metadata
+
+
+def check_compatibility(metadata, filename, backend=None, input_dim=None, n_speakers=None, regression_model=None):
+    """Raises ValueError if the model in filename does not match the expected embeddings and outputs."""
+    config = metadata['architecture']
+    trained_backend = metadata['embedding']['backend']
+    if backend is not None and backend != trained_backend:
+        raise ValueError("{} was trained on {} embeddings, not {}".format(filename, trained_backend, backend))
+    if input_dim is not None and input_dim != config['input_dim']:
+        raise ValueError("{} expects {}-dimensional embeddings, not {}".format(filename, config['input_dim'], input_dim))
+    if n_speakers is not None and n_speakers != len(metadata['speakers']):
+        raise ValueError("{} was trained on {} speakers, not {}".format(filename, len(metadata['speakers']), n_speakers))
+    if regression_model is not None and regression_model != config['regression_model']:
+        raise ValueError("{} is a {} model".format(filename, "regression" if config['regression_model'] else "classification"))
+
+
+def load_trustnet(filename, device="cpu", **expected):
+    """Loads a trustnet file in eval mode. Returns (model, metadata).
+
+    Keyword arguments (backend, input_dim, n_speakers, regression_model) are checked against the metadata
+    (see check_compatibility).
+    """
+    metadata = read_metadata(filename)
+    check_compatibility(metadata, filename, **expected)
+    model = build_trustnet(**{ k: v for k, v in metadata['architecture'].items() if v is not None })
+    # Copy-on-write memory map: tensors share the pages of the file until they are modified.
+    data = np.memmap(filename, dtype=np.uint8, mode="c", offset=metadata['data_offset'])
+    state_dict = {}
+    for description in metadata['tensors']:
+        array = data[description['offset']:description['offset'] + description['nbytes']]
+        array = array.view(np.dtype(description['dtype'])).reshape(description['shape'])
+        state_dict[description['name']] = torch.from_numpy(array)
+    expected_shapes = { name: list(tensor.shape) for name, tensor in model.state_dict().items() }
+    if expected_shapes != { name: list(tensor.shape) for name, tensor in state_dict.items() }:
+        raise ValueError("Weights of {} do not match its architecture".format(filename))
+    model.load_state_dict(state_dict, assign=True)
+    return model.to(device).eval(), metadata
+
+
+def convert(old_filename, filename, speakers, backend, embedding_model=None):
+    """Converts a model saved by torch.save (pickled module or state dict) to a trustnet file."""
+    # Old files are pickles: only convert files you trust.
+    old = torch.load(old_filename, map_location="cpu", weights_only=False)
+    state_dict = old if isinstance(old, dict) else old.state_dict()
+    config = architecture(state_dict)
+    model = build_trustnet(**{ k: v for k, v in config.items() if v is not None })
+    model.load_state_dict(state_dict)
+    save_trustnet(model, filename, speakers, backend, embedding_model)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    info_parser = subparsers.add_parser("info", help="Print the metadata of a trustnet file")
+    info_parser.add_argument("filename", type=str)
+    convert_parser = subparsers.add_parser("convert", help="Convert a model saved with torch.save",
+                                           formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    convert_parser.add_argument("old_filename", type=str)
+    convert_parser.add_argument("filename", type=str)
+    convert_parser.add_argument("--speakers", type=str, nargs="+", required=True)
+    convert_parser.add_argument("--backend", type=str, help="Embedding backend the model was trained on", default="pyannote")
+    convert_parser.add_argument("--embedding-model", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        convert(args.old_filename, args.filename, args.speakers, args.backend, args.embedding_model)
+        print("Converted {} to {}".format(args.old_filename, args.filename))
+    else:
+        metadata = read_metadata(args.filename)
+        print(json.dumps({ k: v for k, v in metadata.items() if k not in ('tensors', 'data_offset') }, indent=2))
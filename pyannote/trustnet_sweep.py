@@ -0,0 +1,137 @@
+"""Hyperparameter and chunking sweep for trustnet.
+
+Trains one trustnet per configuration (hidden dimensions, learning rate,
+epochs, chunk duration, classification or regression) in parallel, one
+configuration per CPU core. Embeddings are computed once per chunk duration
+and come from the embedding cache when available. Writes a table of the
+configurations ranked by test accuracy, with their inference latency.
+Regression models are scored like classifiers (their output rounded to the
+nearest speaker index must be the right speaker), so both rank in one table.
+
+    python trustnet_sweep.py --hidden-dim 16 32 64 --lr 0.01 0.1 --chunk-duration 0.5 1 2
+"""
+import argparse
+import csv
+import itertools
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from torch import nn
+
+from speaker_dataset import SpeakerEmbeddingDataset
+from trustnet import build_trustnet, split, train, accuracy
+
+speakers = ['1-Victor', '2-Sofian', '3-Etienne', '4-Natalia']
+
+
+def inference_latency(model, X, n_runs=200):
+    """Median latency of the model on a single embedding, in milliseconds."""
+    if len(X) == 0:
+        return float('nan')
+    times = []
+    with torch.inference_mode():
+        for i in range(n_runs):
+            x = X[i % len(X)]
+            startTime = time.perf_counter()
+            model(x)
+            times.append(time.perf_counter() - startTime)
+    return 1000 * float(np.median(times))
+
+
+def exact_accuracy(model, X, y, regression_model, n_classes):
+    """Fraction of exactly identified speakers: for regression models, the output rounded to the nearest index."""
+    if not regression_model:
+        return accuracy(model, X, y)
+    if len(X) == 0:
+        return float('nan')
+    model.eval()
+    with torch.no_grad():
+        predicted = torch.round(model(X)).flatten().clamp(0, n_classes - 1)
+    return (predicted == y).float().mean().item()
+
+
+def run(config, X, y, n_classes, seed):
+    # One thread per worker: configurations run in parallel on separate cores.
+    torch.set_num_threads(1)
+    torch.manual_seed(seed)
+    generator = torch.Generator().manual_seed(seed)
+    X = torch.from_numpy(X)
+    y = torch.from_numpy(y).float() if config['regression'] else torch.from_numpy(y).long()
+    (X_train, y_train), (X_test, y_test) = split(X, y, 0.8, generator)
+    (X_train, y_train), (X_val, y_val) = split(X_train, y_train, 0.9, generator)
+
+    model = build_trustnet(X.shape[1], n_classes, config['hidden_dim'], config['hidden_dim2'], config['regression'])
+    criterion = nn.MSELoss() if config['regression'] else nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), lr=config['lr'])
+    history = train(model, criterion, optimizer, X_train, y_train, X_val, y_val, epochs=config['epochs'],
+                    batch_size=config['batch_size'], patience=config['patience'], log_every=0, generator=generator)
+    return dict(config,
+                n_train=len(X_train),
+                n_test=len(X_test),
+                accuracy=exact_accuracy(model, X_test, y_test, config['regression'], n_classes),
+                latency_ms=inference_latency(model, X_test),
+                epochs_run=history['epochs'],
+                epochs_per_second=history['epochs_per_second'])
+
+
+def parse_bool(value):
+    return value.lower() in ['1', 'true', 'yes', 'regression']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--hidden-dim", type=int, nargs="+", default=[32])
+    parser.add_argument("--hidden-dim2", type=int, nargs="+", default=[16])
+    parser.add_argument("--lr", type=float, nargs="+", default=[0.1])
+    parser.add_argument("--epochs", type=int, nargs="+", default=[1000])
+    parser.add_argument("--chunk-duration", type=float, nargs="+", default=[1.0])
+    parser.add_argument("--regression", type=parse_bool, nargs="+", help="Regression model (true) or classification (false)", default=[False])
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--patience", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, help="Number of parallel processes", default=os.cpu_count())
+    parser.add_argument("--output", type=str, help="Results table (CSV)", default="sweep_results.csv")
+    args = parser.parse_args()
+
+    file_paths = [ "./Voices/VOIX TELEO " + s + ".wav" for s in speakers ]
+
+    # Embeddings, once per chunk duration (from the embedding cache when possible).
+    data = {}
+    for chunk_duration in args.chunk_duration:
+        dataset = SpeakerEmbeddingDataset(file_paths, chunk_duration=chunk_duration)
+        data[chunk_duration] = (np.ascontiguousarray(dataset.embeddings), dataset.targets.numpy())
+        print("Chunk duration {} s: {} embeddings".format(chunk_duration, len(dataset)))
+
+    configs = []
+    for hidden_dim, hidden_dim2, lr, epochs, chunk_duration, regression in itertools.product(
+            args.hidden_dim, args.hidden_dim2, args.lr, args.epochs, args.chunk_duration, args.regression):
+        # hidden_dim2 is only used by the regression model.
+        if not regression and hidden_dim2 != args.hidden_dim2[0]:
+            continue
+        configs.append({ 'hidden_dim': hidden_dim, 'hidden_dim2': hidden_dim2, 'lr': lr, 'epochs': epochs,
+                         'chunk_duration': chunk_duration, 'regression': regression,
+                         'batch_size': args.batch_size, 'patience': args.patience })
+    print("Running {} configurations on {} processes".format(len(configs), args.workers))
+
+    startTime = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(run, config, *data[config['chunk_duration']], len(speakers), args.seed) for config in configs]
+        results = [future.result() for future in futures]
+    print("Sweep done in {:.1f} s".format(time.perf_counter() - startTime))
+
+    # Rank by accuracy, then by latency. Configurations without test accuracy (empty test set) come last.
+    results.sort(key=lambda r: (math.isnan(r['accuracy']), -r['accuracy'], r['latency_ms']))
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+
+    columns = ['accuracy', 'latency_ms', 'hidden_dim', 'hidden_dim2', 'lr', 'epochs', 'epochs_run', 'chunk_duration', 'regression']
+    print(" ".join("{:>14s}".format(c) for c in ['rank'] + columns))
+    for rank, r in enumerate(results, 1):
+        print(" ".join("{:>14}".format(v if not isinstance(v, float) else "{:.4f}".format(v)) for v in [rank] + [r[c] for c in columns]))
+    print("Results written to {}".format(args.output))
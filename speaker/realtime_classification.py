@@ -0,0 +1,163 @@
+"""Realtime fan-out of malaya-speech classification heads.
+
+The vggvox-v2 gender, age, emotion and language heads all compute the same
+front-end features (the vggvox-v2 spectrogram) before their own network.
+ClassificationStage computes these features once per VAD segment, for each
+group of heads sharing a featurizer, and runs the heads concurrently on a
+thread pool. The network of each head is run on the shared features exactly as
+malaya-speech's Classification.predict_proba() would run it. On the first
+segment, each sharing head is checked against predict_proba() on the audio;
+heads that differ, or whose model does not expose its featurizer, are called
+directly on the audio.
+
+Per-head latencies are recorded in a PipelineMonitor (pyannote/latency.py). If
+a head is still busy with a previous segment, or does not answer within
+max_latency seconds, its result for the segment is dropped and counted.
+"""
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pyannote'))
+from latency import PipelineMonitor
+
+
+def softmax(x, axis=-1):
+    e = np.exp(x - np.max(x, axis=axis, keepdims=True))
+    return e / e.sum(axis=axis, keepdims=True)
+
+
+class Head:
+    """A malaya-speech classification model, split into featurizer and network when the model allows it.
+
+    The split relies on the internals of malaya_speech.model.tf.Classification (_vectorizer, _extra,
+    _execute), which predict_proba() uses as: vectorize each input, pad, add a channel axis, run the
+    graph from 'Placeholder' to 'logits' and apply a softmax.
+    """
+    def __init__(self, name, model):
+        self.name = name
+        self.model = model
+        self.vectorizer = getattr(model, '_vectorizer', None)
+        self.extra = getattr(model, '_extra', None) or {}
+        # predict_proba() pads deep-speaker features along the first axis, the others along the second.
+        self.padding_dim = 0 if getattr(model, '__model__', None) == 'deep-speaker' else 1
+        self.shares_features = (self.vectorizer is not None and hasattr(model, '_execute')
+                                and hasattr(model, 'predict_proba'))
+        if self.shares_features:
+            try:
+                from malaya_speech.utils.padding import sequence_nd
+                self.padding = sequence_nd
+            except ImportError:
+                self.shares_features = False
+
+    def feature_key(self):
+        """Heads with the same key compute the same features."""
+        return (self.vectorizer, json.dumps(self.extra, sort_keys=True, default=str))
+
+    def features(self, audio):
+        return self.vectorizer(audio, **self.extra)
+
+    def predict_proba(self, features):
+        """Class probabilities of a segment from its features, as model.predict_proba([audio])[0] computes them."""
+        inputs = np.expand_dims(self.padding([features], dim=self.padding_dim), -1)
+        r = self.model._execute(inputs=[inputs], input_labels=['Placeholder'], output_labels=['logits'])
+        return softmax(r['logits'], axis=-1)[0]
+
+    def predict(self, audio=None, features=None):
+        """Label of a segment, from its precomputed features if the head shares them."""
+        if not self.shares_features:
+            return self.model(audio)
+        return self.model.labels[int(np.argmax(self.predict_proba(features)))]
+
+    def check(self, audio, features, tolerance=1e-4):
+        """True if the shared-feature path gives the probabilities of model.predict_proba() on audio."""
+        expected = np.asarray(self.model.predict_proba([audio]))[0]
+        return np.allclose(self.predict_proba(features), expected, rtol=tolerance, atol=tolerance)
+
+
+class ClassificationStage:
+    def __init__(self, models, max_latency=1.0, n_threads=None, verify=True):
+        """models: dict of head name -> malaya-speech classification model.
+
+        verify: check the shared-feature path of each head against its predict_proba() on the first segment.
+        """
+        self.heads = [Head(name, model) for name, model in models.items()]
+        self.max_latency = max_latency
+        self.verify = verify
+        self.executor = ThreadPoolExecutor(max_workers=n_threads or len(self.heads), thread_name_prefix="head")
+        self.monitor = PipelineMonitor(['features'] + [head.name for head in self.heads] + ['total'])
+        self.dropped = { head.name: 0 for head in self.heads }
+        self.busy = { head.name: None for head in self.heads }
+        self.group_heads()
+
+    def group_heads(self):
+        # Heads grouped by featurizer: features are computed once per group.
+        self.groups = {}
+        for head in self.heads:
+            if head.shares_features:
+                self.groups.setdefault(head.feature_key(), []).append(head)
+
+    def check(self, audio, features):
+        """Once: heads whose shared-feature probabilities differ from predict_proba() are called on the audio instead."""
+        self.verify = False
+        for key, heads in self.groups.items():
+            for head in heads:
+                if not head.check(audio, features[key]):
+                    print("{}: shared features differ from predict_proba(), classifying the audio directly".format(head.name))
+                    head.shares_features = False
+        self.group_heads()
+
+    def run_head(self, head, audio, features, start_time):
+        result = head.predict(audio, features)
+        self.monitor.record(head.name, start_time, time.perf_counter())
+        return result
+
+    def __call__(self, sample):
+        """Classifies a VAD segment (int16 samples, as given by malaya_speech.streaming). Returns one label per head (None if dropped)."""
+        import malaya_speech
+        start_time = time.perf_counter()
+        audio = malaya_speech.astype.int_to_float(malaya_speech.astype.to_ndarray(sample))
+
+        features = {}
+        for key, heads in self.groups.items():
+            features[key] = heads[0].features(audio)
+        features_time = time.perf_counter()
+        if self.groups:
+            self.monitor.record('features', start_time, features_time)
+        if self.verify:
+            self.check(audio, features)
+
+        futures = {}
+        for head in self.heads:
+            # A head still working on an older segment skips this one rather than queueing up.
+            if self.busy[head.name] is not None and not self.busy[head.name].done():
+                self.dropped[head.name] += 1
+                continue
+            head_features = features.get(head.feature_key()) if head.shares_features else None
+            futures[head.name] = self.busy[head.name] = self.executor.submit(self.run_head, head, audio, head_features, features_time)
+
+        wait(futures.values(), timeout=max(0.0, self.max_latency - (time.perf_counter() - start_time)))
+        results = []
+        for head in self.heads:
+            future = futures.get(head.name)
+            if future is None:
+                results.append(None)
+            elif not future.done():
+                self.dropped[head.name] += 1
+                results.append(None)
+            else:
+                results.append(future.result())
+        self.monitor.record('total', start_time, time.perf_counter())
+        return tuple(results)
+
+    def report(self):
+        shared = ", ".join(head.name for head in self.heads if head.shares_features) or "none"
+        dropped = " ".join("{}: {}".format(name, n) for name, n in self.dropped.items())
+        return "{}\nheads sharing features: {}\ndropped per head: {}".format(self.monitor.report(), shared, dropped)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -28,14 +28,26 @@ r = p.emit(filepaths)
 
 ##print(model(load_wav(filepaths[0])))
 
-# calculate similarity
-from scipy.spatial.distance import cdist, cosine
-
-inv_dist = 1 - cdist(r['speaker-vector'], r['speaker-vector'], metric = 'cosine')
-print(inv_dist)
-
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-sns.heatmap(inv_dist)
-plt.show()
\ No newline at end of file
+# calculate similarity, in float32 row blocks (see pyannote/similarity.py)
+import os
+import sys
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pyannote'))
+from similarity import SimilarityEngine
+
+engine = SimilarityEngine(np.asarray(r['speaker-vector'], dtype = np.float32))
+names = [os.path.basename(f) for f in filepaths]
+indices, scores = engine.top_k(5)
+for i, name in enumerate(names):
+  print(name, [(names[j], round(float(s), 3)) for j, s in zip(indices[i], scores[i])])
+
+for group in engine.duplicate_groups(0.95):
+  print("Duplicates:", [names[i] for i in group])
+
+max_heatmap = 200
+if len(engine) <= max_heatmap:
+  import matplotlib.pyplot as plt
+  import seaborn as sns
+
+  sns.heatmap(np.concatenate([similarities for start, similarities in engine.blocks()]))
+  plt.show()
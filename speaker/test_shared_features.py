@@ -0,0 +1,28 @@
+import glob
+
+import malaya_speech
+import numpy as np
+
+from realtime_classification import Head
+
+# Shared-feature path of each head vs. malaya-speech's own predict_proba on the same audio.
+models = {
+  'gender': malaya_speech.gender.deep_model(model = 'vggvox-v2'),
+  'language': malaya_speech.language_detection.deep_model(model = 'vggvox-v2'),
+  'emotion': malaya_speech.emotion.deep_model(model = 'vggvox-v2'),
+  'age': malaya_speech.age_detection.deep_model(model = 'vggvox-v2'),
+}
+
+filepaths = sorted(glob.glob("./Voices/split/*.wav"))[:5]
+
+for name, model in models.items():
+  head = Head(name, model)
+  assert head.shares_features, "{} does not expose its featurizer".format(name)
+  for f in filepaths:
+    audio, sr = malaya_speech.load(f)
+    expected = np.asarray(model.predict_proba([audio]))[0]
+    probabilities = head.predict_proba(head.features(audio))
+    assert probabilities.shape == expected.shape, (name, f, probabilities.shape, expected.shape)
+    assert np.allclose(probabilities, expected, rtol = 1e-4, atol = 1e-4), (name, f, probabilities, expected)
+    assert head.predict(audio, head.features(audio)) == model.predict([audio])[0]
+  print("{}: shared features match predict_proba on {} clips".format(name, len(filepaths)))